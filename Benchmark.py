@@ -0,0 +1,179 @@
+# Rough benchmarks to see how fast the different parts of the merger are. Not needed for merging at all.
+# Needs numpy and Pillow on top of the normal requirements: pip install numpy pillow
+# py ./Benchmark.py backends    compares the compositing backends
+# py ./Benchmark.py world -o results.json    generates a fake world and times every phase of merging it
+import argparse, json, os, platform, re, sys, tempfile, time
+from pathlib import Path
+import numpy as np
+import Compositing as comp
+import PngUtils as pu
+
+def make_tile(outPath: Path, rng: np.random.Generator, transparency: float = 0.3, size: int = 512):
+    """
+    Writes a fake 512x512 map tile. Colors come in 16x16 blocks (one per chunk) so it compresses somewhat like a real tile, and a share of the blocks is fully transparent (unexplored).
+    """
+    blocks = size // 16
+    colors = rng.integers(0, 256, size=(blocks, blocks, 4), dtype=np.uint8)
+    colors[..., 3] = np.where(rng.random((blocks, blocks)) < transparency, 0, 255)
+    pixels = colors.repeat(16, axis=0).repeat(16, axis=1)
+    outPath.parent.mkdir(parents=True, exist_ok=True)
+    outPath.write_bytes(pu.encode_rgba8(pixels))
+
+def bench_compositing(tiles: int = 50, layers: int = 3, backends: list[str] | None = None, seed: int = 0):
+    """
+    Composites the same set of fake tiles with every backend and returns the tiles per second for each.
+    """
+    rng = np.random.default_rng(seed)
+    results: dict[str, float] = dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        stacks = list()
+        for tile in range(tiles):
+            stack = [root / str(layer) / f'{tile}.png' for layer in range(layers)]
+            for filePath in stack:
+                make_tile(filePath, rng)
+            stacks.append(stack)
+        for backend in backends or list(comp.BACKENDS):
+            composite = comp.load_backend(backend)
+            start = time.perf_counter()
+            for stack in stacks:
+                composite(*stack)
+            results[backend] = tiles / (time.perf_counter() - start)
+    return results
+
+MAP_TYPES = ('day', 'night', 'topo', 'caves/0')
+
+def generate_world(root: Path, inputs: int = 3, regions: int = 16, dimensions: tuple[str, ...] = ('overworld',), mapTypes: tuple[str, ...] = MAP_TYPES, overlap: float = 0.5, transparency: float = 0.3, waypoints: int = 100, tileSize: int = 512, seed: int = 0):
+    """
+    Writes inputs fake JourneyMap roots into root (input0, input1, ...) and returns their paths.
+    Every dimension/map type gets regions tiles. A share of overlap of them exists in two or more inputs, the rest only in one random input.
+    transparency is the share of every tile that's unexplored. waypoints is the number of waypoints per input, skipped if amulet-nbt isn't installed.
+    """
+    rng = np.random.default_rng(seed)
+    roots = [root / f'input{number}' for number in range(inputs)]
+    side = max(int(np.ceil(np.sqrt(regions))), 1)
+    for dimension in dimensions:
+        for mapType in mapTypes:
+            for region in range(regions):
+                x, z = region % side - side // 2, region // side - side // 2
+                if inputs > 1 and rng.random() < overlap:
+                    owners = rng.choice(inputs, size=rng.integers(2, inputs + 1), replace=False)
+                else:
+                    owners = [rng.integers(0, inputs)]
+                for owner in owners:
+                    make_tile(roots[owner] / dimension / mapType / f'{x},{z}.png', rng, transparency, tileSize)
+    if waypoints:
+        _generate_waypoints(roots, waypoints, dimensions, rng)
+    return roots
+
+def _generate_waypoints(roots: list[Path], count: int, dimensions: tuple[str, ...], rng: np.random.Generator):
+    try:
+        import amulet.nbt as anbt
+    except ImportError:
+        print('amulet-nbt is not installed, not generating waypoints')
+        return
+    for root in roots:
+        waypoints = dict()
+        for number in range(count):
+            # Half of them are shared between all inputs (same key), the rest is unique per input
+            key = f'shared{number}' if number % 2 else f'{root.name}-{number}'
+            waypoints[key] = anbt.CompoundTag({
+                'name': anbt.StringTag(f'Waypoint {number}'),
+                'primaryDimension': anbt.StringTag(str(rng.choice(dimensions))),
+                'pos': anbt.CompoundTag({axis: anbt.IntTag(int(rng.integers(-5000, 5000))) for axis in ('x', 'y', 'z')}),
+            })
+        data = anbt.NamedTag(anbt.CompoundTag({'waypoints': anbt.CompoundTag(waypoints), 'groups': anbt.CompoundTag()}), '')
+        outPath = root / 'waypoints' / 'WaypointData.dat'
+        outPath.parent.mkdir(parents=True, exist_ok=True)
+        outPath.write_bytes(data.to_nbt(compressed=False, little_endian=False, string_encoding=anbt.mutf8_encoding))
+
+def _timed(func, *args, **kwargs):
+    # Returns the result of func together with the wall and CPU seconds it took
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    return result, {'seconds': time.perf_counter() - wall, 'cpuSeconds': time.process_time() - cpu}
+
+def bench_world(roots: list[Path], backend: str = 'numpy', topDown: bool = False, preset: str = pu.DEFAULT_PRESET, byTime: bool = False):
+    """
+    Runs every phase of a merge on the given roots, one after another and in this process, so the numbers aren't muddied by the process pool.
+    Returns a dict with the timings of every phase.
+    """
+    import CompareFolders as cf
+    import TilePlanner as tp
+    phases = dict()
+
+    index, phases['scan'] = _timed(cf.index_files, roots, byTime, re.compile('\\.png$').search)
+    phases['scan']['files'] = index.scanned
+
+    (singleSource, needsCompositing), phases['plan'] = _timed(tp.plan_tiles, index)
+    phases['plan'].update({'tiles': len(index), 'singleSource': len(singleSource), 'needsCompositing': len(needsCompositing)})
+
+    composite = comp.load_backend(backend)
+    def composite_all():
+        stats = comp.new_stats()
+        written = 0
+        for tileId in needsCompositing:
+            written += len(composite(*index.sources(tileId), topDown=topDown, stats=stats, preset=preset))
+        return stats, written
+    (stats, written), phases['composite'] = _timed(composite_all)
+    phases['composite'].update({'tiles': len(needsCompositing), 'layers': sum(map(index.layer_count, needsCompositing)), 'bytesWritten': written, **stats})
+    phases['composite']['tilesPerSecond'] = len(needsCompositing) / max(phases['composite']['seconds'], 1e-9)
+
+    waypointFiles = [root / 'waypoints' / 'WaypointData.dat' for root in roots if (root / 'waypoints' / 'WaypointData.dat').is_file()]
+    if waypointFiles:
+        import JourneyMapMerger as jmm
+        with tempfile.TemporaryDirectory() as tmp:
+            irrelevant, phases['waypoints'] = _timed(jmm.merge_waypoint_data_and_save, [Path(tmp) / 'WaypointData.dat'], *waypointFiles)
+        phases['waypoints']['files'] = len(waypointFiles)
+    return phases
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the merger, on fake JourneyMap data.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    backendsParser = subparsers.add_parser('backends', help="Compare the compositing backends.")
+    backendsParser.add_argument("--tiles", type=int, default=50, help="How many tiles to composite per backend.")
+    backendsParser.add_argument("--layers", type=int, default=3, help="How many layers every tile has.")
+    backendsParser.add_argument("--backend", action="append", choices=list(comp.BACKENDS), help="Only benchmark this backend. Can be given multiple times.")
+
+    worldParser = subparsers.add_parser('world', help="Generate a fake world and time every phase of merging it.")
+    worldParser.add_argument("--inputs", type=int, default=3, help="How many input roots to generate.")
+    worldParser.add_argument("--regions", type=int, default=16, help="Tiles per dimension and map type.")
+    worldParser.add_argument("--dimension", action="append", help="Dimension to generate. Can be given multiple times, defaults to overworld.")
+    worldParser.add_argument("--type", action="append", help=f"Map type to generate. Can be given multiple times, defaults to {', '.join(MAP_TYPES)}.")
+    worldParser.add_argument("--overlap", type=float, default=0.5, help="Share of tiles that exist in more than one input.")
+    worldParser.add_argument("--transparency", type=float, default=0.3, help="Share of every tile that's unexplored.")
+    worldParser.add_argument("--waypoints", type=int, default=100, help="Waypoints per input.")
+    worldParser.add_argument("--tile-size", type=int, default=512, help="Width and height of every tile. JourneyMap uses 512.")
+    worldParser.add_argument("--seed", type=int, default=0)
+    worldParser.add_argument("--backend", choices=list(comp.BACKENDS), default='numpy')
+    worldParser.add_argument("--top-down", action="store_true")
+    worldParser.add_argument("--preset", choices=list(pu.PRESETS), default=pu.DEFAULT_PRESET)
+    worldParser.add_argument("--keep", type=str, help="Generate the world into this folder and keep it, instead of a temporary folder.")
+    worldParser.add_argument("-o", "--output", type=str, help="Write the results as JSON to this file, so runs can be compared later.")
+    args = parser.parse_args()
+
+    if args.command == 'backends':
+        for backend, tilesPerSecond in bench_compositing(args.tiles, args.layers, args.backend).items():
+            print(f'{backend}: {tilesPerSecond:.1f} tiles/s')
+    else:
+        config = {key: value for key, value in vars(args).items() if key not in ('command', 'keep', 'output')}
+        config['dimension'] = tuple(args.dimension or ('overworld',))
+        config['type'] = tuple(args.type or MAP_TYPES)
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(args.keep) if args.keep else Path(tmp)
+            roots, generation = _timed(generate_world, root, args.inputs, args.regions, config['dimension'], config['type'], args.overlap, args.transparency, args.waypoints, args.tile_size, args.seed)
+            print(f'Generated {len(roots)} inputs in {generation["seconds"]:.1f}s')
+            phases = bench_world(roots, args.backend, args.top_down, args.preset)
+        results = {
+            'config': config,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'phases': phases,
+        }
+        for name, phase in phases.items():
+            print(f'{name}: {phase["seconds"]:.3f}s')
+        if args.output:
+            Path(args.output).write_text(json.dumps(results, indent=2, default=list), encoding='utf-8')
+            print(f'Results written to {args.output}')
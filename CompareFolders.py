@@ -1,95 +1,236 @@
 from pathlib import Path, PurePath
-import os
+import os, queue, threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pp
 from tqdm import tqdm
+import ZipArchives as za
+
+# (root index, relative path with / as separator, last modified timestamp, size in bytes)
+type ScanEntry = tuple[int, str, float, int]
+
+def _scan_dir(rootIndex: int, directory: str, relative: str):
+    """
+    Lists a single directory. Returns the files in it as ScanEntries and the subdirectories that still need scanning.
+    """
+    files: list[ScanEntry] = list()
+    subdirs: list[tuple[str, str]] = list()
+    try:
+        iterator = os.scandir(directory)
+    except OSError:
+        # Same as rglob, unreadable directories are just skipped
+        return files, subdirs
+    with iterator:
+        for entry in iterator:
+            entryRelative = relative + entry.name
+            try:
+                # DirEntry caches what the OS already told us while listing the directory, so is_dir/is_file usually don't cost an extra system call. On Windows stat is free as well.
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((entry.path, entryRelative + '/'))
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append((rootIndex, entryRelative, stat.st_mtime, stat.st_size))
+            except OSError:
+                # Deleted while we were looking at it
+                continue
+    return files, subdirs
+
+def scan_roots(*roots: Path, workers: int = 16, zipPrefixes: dict[int, str] | None = None, descend = None):
+    """
+    Walks all roots at the same time and yields a ScanEntry for every file, as soon as it's found. Every directory is its own job, so big roots get split up between the workers as well.
+    Roots that are ZIP archives are listed in one go instead, relative to their prefix in zipPrefixes (see ZipArchives.data_prefix).
+    descend can be a function that gets the relative path of a subdirectory (ending with /) and returns if it should be scanned at all.
+    The order of the entries is random-ish, sort them yourself if you need to.
+    NOTE: Only the listing itself is overlapped. index_files (and with it planning and merging) still takes everything before it starts, a layer order can't be decided until every root has been seen.
+    """
+    zipPrefixes = zipPrefixes or dict()
+    if not roots:
+        return
+    results: queue.Queue[list[ScanEntry] | BaseException | None] = queue.Queue()
+    lock = threading.Lock()
+    # Starts at 1 so the scan can't count as finished while we're still handing out the roots
+    pending = 1
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(rootIndex: int, directory: str, relative: str):
+        nonlocal pending
+        with lock:
+            pending += 1
+        executor.submit(work, rootIndex, directory, relative)
+
+    def work(rootIndex: int, directory: str, relative: str):
+        try:
+            if rootIndex in zipPrefixes:
+                files, subdirs = za.scan_zip(rootIndex, Path(directory), zipPrefixes[rootIndex]), list()
+            else:
+                files, subdirs = _scan_dir(rootIndex, directory, relative)
+            # Queue up the subdirectories before we count ourselves as done, otherwise the scan could look finished too early
+            for subdir, subRelative in subdirs:
+                if descend is None or descend(subRelative):
+                    submit(rootIndex, subdir, subRelative)
+            results.put(files)
+        except BaseException as e:
+            results.put(e)
+        finally:
+            done()
+
+    def done():
+        nonlocal pending
+        with lock:
+            pending -= 1
+            if pending == 0:
+                results.put(None)
+
+    for rootIndex, root in enumerate(roots):
+        submit(rootIndex, str(root), '')
+    done()
+    try:
+        while (batch := results.get()) is not None:
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+class TileIndex:
+    """
+    Every file of every root, grouped by the path relative to its root, without a Path object or a dict per file.
+    Relative paths are stored once (their position is the tile id), everything else is in flat arrays. The contributors of tile i are the rows offsets[i] to offsets[i + 1], already in layer order.
+    It pickles small enough to hand it to every worker once, after that a tile id is all a worker needs.
+    """
+    def __init__(self, roots: list[Path], zipPrefixes: dict[int, str] | None = None):
+        self.roots = list(roots)
+        # Root id -> where the data starts inside the archive, for roots that are ZIPs
+        self.zipPrefixes = zipPrefixes or dict()
+        self.paths: list[str] = list()
+        self.offsets = array('q', [0])
+        self.rootIds = array('H')
+        self.mtimes = array('d')
+        self.sizes = array('q')
+        # How many files the scan saw in total, including the ones that were filtered out
+        self.scanned = 0
+        # Filled in by TilePlanner.dedupe_contributors: content digest of every row that got hashed, and the rows that are a copy of a layer above them
+        self.digests: dict[int, str] = dict()
+        self.duplicates: set[int] = set()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def tiles(self):
+        return range(len(self.paths))
+
+    def relative(self, tileId: int):
+        return self.paths[tileId]
+
+    def rows(self, tileId: int):
+        return range(self.offsets[tileId], self.offsets[tileId + 1])
+
+    def layers(self, tileId: int):
+        """
+        The rows that actually have to be layered, without the duplicates. Same as rows unless contributors were deduplicated.
+        """
+        if not self.duplicates:
+            return self.rows(tileId)
+        return [row for row in self.rows(tileId) if row not in self.duplicates]
+
+    def layer_count(self, tileId: int):
+        return len(self.layers(tileId))
+
+    def layer_bytes(self, tileId: int):
+        return sum(self.sizes[row] for row in self.layers(tileId))
+
+    def source(self, row: int, relative: str):
+        rootId = self.rootIds[row]
+        if rootId in self.zipPrefixes:
+            return za.ZipMember(self.roots[rootId], self.zipPrefixes[rootId] + relative)
+        return self.roots[rootId] / relative
+
+    def sources(self, tileId: int):
+        """
+        Absolute paths of all contributors of a tile that have to be layered, bottom layer first. Contributors inside a ZIP are ZipMembers instead.
+        """
+        relative = self.paths[tileId]
+        return [self.source(row, relative) for row in self.layers(tileId)]
+
+    def stamps(self, tileId: int):
+        """
+        [absolute path, mtime, size] of all contributors of a tile, bottom layer first. Includes duplicates, they're still inputs of the tile.
+        """
+        relative = self.paths[tileId]
+        return [[str(self.source(row, relative)), self.mtimes[row], self.sizes[row]] for row in self.rows(tileId)]
+
+def index_files(roots: list[Path], byTime: bool, match = None, descend = None):
+    """
+    Scans all roots and groups the files by their path relative to their root into a TileIndex.
+    If byTime is set, the contributors go from oldest to newest, otherwise they're in the order the roots were given.
+    match can be a function that gets the relative path (with / as separator) and returns if the file should be in the index. descend does the same for directories, see scan_roots.
+    Returns only once the whole scan is done, nothing downstream overlaps with it.
+    """
+    index = TileIndex(roots, {rootIndex: za.data_prefix(root) for rootIndex, root in enumerate(roots) if za.is_zip(root)})
+    # First collect everything as flat columns in scan order, interning the relative paths on the way
+    tileIds: dict[str, int] = dict()
+    rowTiles = array('q')
+    rowRoots = array('H')
+    rowTimes = array('d')
+    rowSizes = array('q')
+    for rootIndex, relative, mtime, size in tqdm(scan_roots(*roots, zipPrefixes=index.zipPrefixes, descend=descend), desc='Getting Files', unit=' files'):
+        index.scanned += 1
+        if match is not None and not match(relative):
+            continue
+        tileId = tileIds.get(relative)
+        if tileId is None:
+            tileId = tileIds[relative] = len(index.paths)
+            index.paths.append(relative)
+        rowTiles.append(tileId)
+        rowRoots.append(rootIndex)
+        rowTimes.append(mtime)
+        rowSizes.append(size)
+    del tileIds
+
+    # Counting sort by tile, so every tile gets one continuous block of rows
+    counts = array('q', bytes(8 * len(index.paths)))
+    for tileId in rowTiles:
+        counts[tileId] += 1
+    offsets = index.offsets
+    for count in counts:
+        offsets.append(offsets[-1] + count)
+    nextFree = array('q', offsets[:-1])
+    order = array('q', bytes(8 * len(rowTiles)))
+    for row, tileId in enumerate(rowTiles):
+        order[nextFree[tileId]] = row
+        nextFree[tileId] += 1
+    del counts, nextFree, rowTiles
+
+    # Then sort the few rows of every tile into layer order. Same timestamps are ordered like the roots were given.
+    for tileId in range(len(index.paths)):
+        start, end = offsets[tileId], offsets[tileId + 1]
+        block = order[start:end]
+        if len(block) > 1:
+            if byTime:
+                block = sorted(block, key=lambda x : (rowTimes[x], rowRoots[x]))
+            else:
+                block = sorted(block, key=lambda x : rowRoots[x])
+        for row in block:
+            index.rootIds.append(rowRoots[row])
+            index.mtimes.append(rowTimes[row])
+            index.sizes.append(rowSizes[row])
+    return index
 
 def compare(baseFolder: Path, *moreFolders: Path):
     """
     "Simple" script to take n-Folders with similar folder structure and compare each and every file based on the last modified timestamp.
     Spits out a dict with each path from each folders root assigned another array with the actual paths from oldest to newest.
     """
-    pathsList = [baseFolder, *moreFolders]
-    pathsListMapped = list(map(lambda x : [x, dict()], pathsList))
-
-    # Should contain a dict of Path keys with more dicts attached to them. The dicts will contain all files and their absolute path with timestamp
-    # So to find a single specific file it would look something like this: paths[0][Path('my/path/one')][Path('/home/user/Documents/my/path/one/README.md')] = 1756136450000
-    paths: dict[Path, dict[Path, float]] = dict(pathsListMapped)
-
-    # Iterate over each parent Folder
-    for path, irrelevant in tqdm(paths.items(), desc='Getting Files and Time'):
-        # Get all files - Note: COMPUTATIONALLY EXPENSIVE. If you know how to improve performance and keep it working on all platforms, make a pull request.
-        files = sorted(path.rglob('*'))
-        files = list(filter(lambda x : x.is_file(), files))
-        # Map each file to last creation
-        filesTimeMapped = dict(map(lambda x : [x, os.path.getmtime(str(x))], files))
-        paths[path] = filesTimeMapped
-
-    # Iterate over all of them again, this time keeping the same root and "merging" the entries
-    # This can be represented as result[PurePath('README.md')] = [Path('/home/user/Documents/my/path/one/README.md), Path('/home/user/Documents/my/path/two/README.md)]
-    root: dict[PurePath, dict[Path, float]] = dict()
-    for parentPath, contents in tqdm(paths.items(), desc='Fuse different Roots'):
-        for filePath, time in tqdm(contents.items(), desc='File progress', leave=False):
-            # Get relative path, this cuts out things like '/home/user/Documents' from before the path, essentially making this our own root
-            relative = PurePath(filePath).relative_to(parentPath)
-            # Get already existing entries in result variable
-            filesInDict: dict[Path, float] = root.get(relative, dict())
-            # Set key-value time based on real absolute path
-            filesInDict[filePath] = time
-            # Set data back into the dict
-            root[relative] = filesInDict
-
-    # Now that we have all the necessary data set, it's time to loop over it AGAIN and sort out some other things
-    rootTmp = root
-    for rootFile, absoluteFiles in tqdm(root.items(), desc='Sort by time'):
-        # Fix up candidates/absoluteFiles, by removing the associated time and just sorting it and returning it as a list
-        # https://stackoverflow.com/a/7340031
-        root[rootFile] = sorted(absoluteFiles, key=absoluteFiles.get)
-    
-    result: dict[PurePath, list[Path]] = rootTmp # Fix up type hintings
+    index = index_files([baseFolder, *moreFolders], byTime=True)
+    result: dict[PurePath, list[Path]] = {PurePath(index.relative(tileId)): index.sources(tileId) for tileId in index.tiles()}
     return result
 
 def merge(baseFolder: Path, *moreFolders: Path):
     """
     Same as the compare function, except this one disregards the timestamp and merges them by order as they're given.
     """
-    # I just copied the whole function and changed a few things because the other one used dicts and this one just goes straight to lists, so it would be a pain to have one function do two things
-    # TODO: offload common tasks between the two functions to different function
-    pathsList = [baseFolder, *moreFolders]
-    pathsListMapped = list(map(lambda x : [x, list()], pathsList))
-
-    # Should contain a dict of Path keys with more lists attached to them. The lists will contain all files and their absolute path
-    # So to find a single specific file it would look something like this: paths[0][Path('my/path/one')][Path('/home/user/Documents/my/path/one/README.md')] = 1756136450000
-    paths: dict[Path, list[Path]] = dict(pathsListMapped)
-
-    # Iterate over each parent Folder
-    for path, irrelevant in tqdm(paths.items(), desc='Getting Files'):
-        # Get all files - Note: COMPUTATIONALLY EXPENSIVE. If you know how to improve performance and keep it working on all platforms, make a pull request.
-        files = sorted(path.rglob('*'))
-        files = list(filter(lambda x : x.is_file(), files))
-        paths[path] = files
-
-    # Iterate over all of them again, this time keeping the same root and "merging" the entries
-    # This can be represented as result[PurePath('README.md')] = [Path('/home/user/Documents/my/path/one/README.md), Path('/home/user/Documents/my/path/two/README.md)]
-    root: dict[PurePath, list[Path]] = dict()
-    for parentPath, contents in tqdm(paths.items(), desc='Fuse different Roots'):
-        for filePath in tqdm(contents, desc='File progress', leave=False):
-            # Get relative path, this cuts out things like '/home/user/Documents' from before the path, essentially making this our own root
-            relative = PurePath(filePath).relative_to(parentPath)
-            # Get already existing entries in result variable
-            filesInDict: list[Path] = root.get(relative, list())
-            # Append Absolute Path to Relative Path
-            filesInDict.append(filePath)
-            # Set data back into the dict
-            root[relative] = filesInDict
-
-    # Now that we have all the necessary data set, it's time to loop over it AGAIN and sort out some other things
-    rootTmp = root
-    # for rootFile, absoluteFiles in root.items():
-    #     # Fix up candidates/absoluteFiles, by removing the associated time and just sorting it and returning it as a list
-    #     # https://stackoverflow.com/a/7340031
-    #     root[rootFile] = sorted(absoluteFiles, key=absoluteFiles.get)
-    
-    result: dict[PurePath, list[Path]] = rootTmp # Fix up type hintings
+    index = index_files([baseFolder, *moreFolders], byTime=False)
+    result: dict[PurePath, list[Path]] = {PurePath(index.relative(tileId)): index.sources(tileId) for tileId in index.tiles()}
     return result
 
 # pp(compare(Path("D:\\MyFiles\\Moon - My Love\\file merger by last modified\\Anya~Leo - pc"), Path("D:\\MyFiles\\Moon - My Love\\file merger by last modified\\Anya~Leo - laptop")))
@@ -0,0 +1,283 @@
+# The different ways of layering map tiles on top of each other. Every backend takes the input files (oldest/bottom first) and returns the finished PNG as bytes.
+# Inputs can be paths or the already read bytes of the files, so the caller can read files ahead of time.
+# Backends can also be asked to go top-down: start with the newest layer and only read older layers for pixels that aren't covered yet.
+# If a stats dict is passed in, the backend counts how many layers it actually read and how many it could skip, and how long reading, decoding, compositing and encoding took.
+import hashlib, io, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING
+import PngUtils as pu
+
+# Both backends need big libraries (ImageMagick through wand, numpy and Pillow) that take a while to import. They only get imported once a backend is actually used, so a worker only ever loads the one it runs.
+if TYPE_CHECKING:
+    from wand.image import Image
+
+def _wand():
+    # https://docs.wand-py.org/en/0.6.12/guide/draw.html#composite
+    from wand.image import Image
+    from wand.drawing import Drawing
+    return Image, Drawing
+
+# Optional, only needed for the numpy backend. Filled in by _import_numpy.
+np = None
+PILImage = None
+
+def _import_numpy():
+    global np, PILImage
+    if np is None:
+        try:
+            import numpy
+            from PIL import Image
+        except ImportError:
+            return False
+        np, PILImage = numpy, Image
+    return True
+
+def new_stats():
+    return {'layersRead': 0, 'layersSkipped': 0, 'topCopied': 0, 'decodeCacheHits': 0, 'readSeconds': 0.0, 'decodeSeconds': 0.0, 'compositeSeconds': 0.0, 'encodeSeconds': 0.0}
+
+def _count(stats: dict | None, key: str, amount: int = 1):
+    if stats is not None:
+        stats[key] += amount
+
+@contextmanager
+def _timing(stats: dict | None, key: str):
+    # A perf_counter call is nothing compared to decoding a tile, so this is always on
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _count(stats, key, time.perf_counter() - start)
+
+def _load(source: Path | bytes, stats: dict | None = None):
+    # Paths and ZipMembers both know how to read themselves
+    if isinstance(source, bytes):
+        return source
+    with _timing(stats, 'readSeconds'):
+        return source.read_bytes()
+
+def _wand_to_pngj_blob(image: 'Image', preset: str = pu.DEFAULT_PRESET):
+    # The library used by journeymap for png writing and reading (PNGJ) is very brittle, so we need to change more parameters to make it not throw up and error out with "all rows have not been written" https://github.com/leonbloy/pngj/blob/fd2a2ea75a517b9d21d97a3b9280df3cc33572d6/src/main/java/ar/com/hjg/pngj/PngWriter.java#L283
+    # TI figured out like half of the parameters, but Gemini and ChatGPT kinda forced me to apply EVERYTHING at once which is why it now properly works
+    # NOTE: Theoretically, the map works without any of these parameters! It only becomes a problem once you try to export the map.
+    # NOTE: I feel like only one or two of these are needed, but I'm too lazy too test so imma just keep it as-is. And it doesn't cost performance either way.
+    image.strip()
+    image.compression = 'zip'
+    image.interlace_scheme = 'no'
+    image.artifacts['png:color-type'] = '6'
+    image.artifacts['png:bit-depth'] = '8'
+    image.artifacts['PNG:format'] = 'png32'
+    # Level and filter come from the encoder preset
+    image.artifacts['PNG:compression-filter'] = str(pu.FILTER_TYPES[pu.PRESETS[preset]['filter']])
+    image.artifacts['PNG:compression-level'] = str(pu.PRESETS[preset]['level'])
+    image.artifacts['PNG:compression-strategy'] = '0'
+    image.artifacts['png:exclude-chunk'] = 'all'
+    return image.make_blob('png')
+
+def _wand_is_opaque(image: 'Image'):
+    return image.range_channel('alpha')[0] >= image.quantum_range
+
+def composite_wand(*inPaths: Path | bytes, topDown: bool = False, stats: dict | None = None, preset: str = pu.DEFAULT_PRESET):
+    """
+    Layers the images with ImageMagick. Slow-ish, but it's what we've always used.
+    """
+    if topDown:
+        return _composite_wand_top_down(*inPaths, stats=stats, preset=preset)
+    Image, Drawing = _wand()
+    # The first image will be our bottom most image, every other one gets drawn onto it and closed right away. Only two images are ever open, no matter how many layers there are.
+    data = _load(inPaths[0], stats)
+    with _timing(stats, 'decodeSeconds'):
+        first = Image(blob=data)
+    _count(stats, 'layersRead')
+    with first:
+        first.alpha_channel = True
+        for filePath in inPaths[1:]:
+            # Get File data and open image into ImageMagick
+            data = _load(filePath, stats)
+            with _timing(stats, 'decodeSeconds'):
+                image = Image(blob=data)
+            _count(stats, 'layersRead')
+            with image, Drawing() as draw, _timing(stats, 'compositeSeconds'):
+                draw.composite('over', 0, 0, image.width, image.height, image)
+                # Draw the composite effects on the base image
+                draw(first)
+        with _timing(stats, 'encodeSeconds'):
+            return _wand_to_pngj_blob(first, preset)
+
+def _composite_wand_top_down(*inPaths: Path | bytes, stats: dict | None = None, preset: str = pu.DEFAULT_PRESET):
+    # Newest layer first, every older layer gets painted *underneath* (dst_over) until nothing shines through anymore
+    Image, Drawing = _wand()
+    topData = _load(inPaths[-1], stats)
+    _count(stats, 'layersRead')
+    with _timing(stats, 'decodeSeconds'):
+        result = Image(blob=topData)
+    with result:
+        result.alpha_channel = True
+        if _wand_is_opaque(result):
+            _count(stats, 'layersSkipped', len(inPaths) - 1)
+            # Nothing to layer at all, the top file already is the result
+            with _timing(stats, 'encodeSeconds'):
+                stripped = pu.strip_to_pngj(topData)
+                if stripped is not None:
+                    _count(stats, 'topCopied')
+                    return stripped
+                return _wand_to_pngj_blob(result, preset)
+        for position, filePath in enumerate(reversed(inPaths[:-1])):
+            data = _load(filePath, stats)
+            with _timing(stats, 'decodeSeconds'):
+                image = Image(blob=data)
+            with image:
+                _count(stats, 'layersRead')
+                with _timing(stats, 'compositeSeconds'):
+                    result.composite(image, 0, 0, operator='dst_over')
+                    opaque = _wand_is_opaque(result)
+            if opaque:
+                _count(stats, 'layersSkipped', len(inPaths) - 2 - position)
+                break
+        with _timing(stats, 'encodeSeconds'):
+            return _wand_to_pngj_blob(result, preset)
+
+def _read_rgba(source: Path | bytes, shape: tuple[int, int] | None = None):
+    # Decodes a file (or its bytes) into a (height, width, 4) uint8 array. If shape is given, the image gets cropped/padded to it, same as drawing it at 0,0 onto a canvas of that size.
+    with PILImage.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+        pixels = np.asarray(image.convert('RGBA'))
+    return _fit(pixels, shape)
+
+def _fit(pixels, shape: tuple[int, int] | None):
+    if shape is None or pixels.shape[:2] == shape:
+        return pixels
+    canvas = np.zeros((*shape, 4), dtype=np.uint8)
+    height, width = min(shape[0], pixels.shape[0]), min(shape[1], pixels.shape[1])
+    canvas[:height, :width] = pixels[:height, :width]
+    return canvas
+
+# Decoded layers by content hash, so a file that shows up again (the same empty tile all over the place, ...) only gets decoded once per worker. Off unless enable_decode_cache gets called.
+# Only the numpy backend uses it, wand images get changed while layering so they can't be shared.
+_decodeCache: OrderedDict | None = None
+_decodeCacheEntries = 0
+
+def enable_decode_cache(entries: int = 64):
+    """
+    Keeps the last entries decoded layers around. A 512x512 tile is 1 MiB decoded, so the default costs up to 64 MiB per worker.
+    """
+    global _decodeCache, _decodeCacheEntries
+    _decodeCache = OrderedDict()
+    _decodeCacheEntries = entries
+
+def _decode(data: bytes, shape: tuple[int, int] | None = None, stats: dict | None = None):
+    # _read_rgba with the cache in front of it. Hashing is a lot cheaper than inflating and unfiltering.
+    if _decodeCache is None:
+        return _read_rgba(data, shape)
+    key = hashlib.sha1(data).digest()
+    pixels = _decodeCache.get(key)
+    if pixels is not None:
+        _decodeCache.move_to_end(key)
+        _count(stats, 'decodeCacheHits')
+        return _fit(pixels, shape)
+    pixels = _read_rgba(data)
+    # Everyone gets the same array, so nobody is allowed to scribble on it
+    pixels.flags.writeable = False
+    _decodeCache[key] = pixels
+    if len(_decodeCache) > _decodeCacheEntries:
+        _decodeCache.popitem(last=False)
+    return _fit(pixels, shape)
+
+def _unpremultiply(premultiplied, outAlpha):
+    # Fully transparent pixels just stay black
+    color = np.divide(premultiplied, outAlpha, out=np.zeros_like(premultiplied), where=outAlpha > 0)
+    result = np.concatenate([color, outAlpha], axis=-1)
+    return np.clip(np.rint(result * 255), 0, 255).astype(np.uint8)
+
+def _fold(premultiplied, alpha, layer):
+    # One step of "over": puts layer on top of everything so far. Works in place, so memory stays at the result so far plus the current layer.
+    rgba = layer.astype(np.float32) / 255
+    if premultiplied is None:
+        return rgba[..., :3] * rgba[..., 3:], rgba[..., 3:].copy()
+    through = 1 - rgba[..., 3:]
+    premultiplied *= through
+    premultiplied += rgba[..., :3] * rgba[..., 3:]
+    alpha *= through
+    alpha += rgba[..., 3:]
+    return premultiplied, alpha
+
+def composite_numpy(*inPaths: Path | bytes, topDown: bool = False, stats: dict | None = None, preset: str = pu.DEFAULT_PRESET):
+    """
+    Layers the images in-process with numpy instead of going through ImageMagick. Output is the same PNGJ safe RGBA8 PNG the wand backend writes.
+    """
+    _import_numpy()
+    if topDown:
+        return _composite_numpy_top_down(*inPaths, stats=stats, preset=preset)
+    # Porter-Duff "over", bottom layer first. Read, decode and fold one layer at a time, so only the result so far and the current layer are in memory.
+    premultiplied = alpha = shape = None
+    for filePath in inPaths:
+        data = _load(filePath, stats)
+        with _timing(stats, 'decodeSeconds'):
+            layer = _decode(data, shape, stats)
+        _count(stats, 'layersRead')
+        # Everything gets cropped/padded to the size of the bottom layer
+        shape = layer.shape[:2]
+        with _timing(stats, 'compositeSeconds'):
+            premultiplied, alpha = _fold(premultiplied, alpha, layer)
+        del data, layer
+    with _timing(stats, 'compositeSeconds'):
+        pixels = _unpremultiply(premultiplied, alpha)
+    with _timing(stats, 'encodeSeconds'):
+        return pu.encode_rgba8(pixels, preset)
+
+def _composite_numpy_top_down(*inPaths: Path | bytes, stats: dict | None = None, preset: str = pu.DEFAULT_PRESET):
+    # Same math as _fold, just walking down: every layer only adds what still shines through everything above it
+    # The output size is the size of the bottom layer, but we don't want to read it just for that. Tiles are always the same size anyway, so the top layer decides.
+    topData = _load(inPaths[-1], stats)
+    with _timing(stats, 'decodeSeconds'):
+        top = _decode(topData, stats=stats)
+    _count(stats, 'layersRead')
+    if (top[..., 3] == 255).all():
+        _count(stats, 'layersSkipped', len(inPaths) - 1)
+        # Nothing to layer at all, the top file already is the result
+        with _timing(stats, 'encodeSeconds'):
+            stripped = pu.strip_to_pngj(topData)
+            if stripped is not None:
+                _count(stats, 'topCopied')
+                return stripped
+            return pu.encode_rgba8(top, preset)
+    with _timing(stats, 'compositeSeconds'):
+        rgba = top.astype(np.float32) / 255
+        premultiplied = rgba[..., :3] * rgba[..., 3:]
+        # The coverage mask: 0 where a pixel is already fully covered, anything else is how much still shines through
+        through = 1 - rgba[..., 3:]
+    for position, filePath in enumerate(reversed(inPaths[:-1])):
+        data = _load(filePath, stats)
+        with _timing(stats, 'decodeSeconds'):
+            layer = _decode(data, top.shape[:2], stats)
+        _count(stats, 'layersRead')
+        with _timing(stats, 'compositeSeconds'):
+            rgba = layer.astype(np.float32) / 255
+            premultiplied += rgba[..., :3] * rgba[..., 3:] * through
+            through *= 1 - rgba[..., 3:]
+            covered = not through.any()
+        if covered:
+            _count(stats, 'layersSkipped', len(inPaths) - 2 - position)
+            break
+    with _timing(stats, 'compositeSeconds'):
+        pixels = _unpremultiply(premultiplied, 1 - through)
+    with _timing(stats, 'encodeSeconds'):
+        return pu.encode_rgba8(pixels, preset)
+
+def numpy_available():
+    return _import_numpy()
+
+BACKENDS = {
+    'wand': composite_wand,
+    'numpy': composite_numpy,
+}
+
+def load_backend(name: str):
+    """
+    Imports everything a backend needs right away and returns its function. Raises ImportError if its libraries are missing.
+    """
+    if name == 'wand':
+        _wand()
+    elif not _import_numpy():
+        raise ImportError('The numpy backend needs numpy and Pillow: pip install numpy pillow')
+    return BACKENDS[name]
\ No newline at end of file
@@ -0,0 +1,192 @@
+# Turns the merged map into something to look at: one big overview image per dimension and map type, and a zoom pyramid of tiles for web maps (Leaflet, OpenLayers, ...)
+# Needs numpy and Pillow on top of the normal requirements: pip install numpy pillow
+import json, math, os, shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
+import CompareFolders as cf
+import PngUtils as pu
+import Selection as sel
+import TilePlanner as tp
+
+# Lives in the root of the export folder and remembers which regions the pyramid was built from
+STATE_NAME = '.journeymap-export.json'
+STATE_VERSION = 1
+TILE_SIZE = 512
+
+def available():
+    try:
+        import numpy
+        from PIL import Image
+    except ImportError:
+        return False
+    return True
+
+def find_regions(outRoot: Path):
+    """
+    All map tiles of a merged output folder, grouped by dimension and map type.
+    Returns {'<dimension>/<map type>': {(x, z): (relative path, [mtime, size])}}.
+    """
+    groups: dict[str, dict[tuple[int, int], tuple[str, list]]] = dict()
+    for rootIndex, relative, mtime, size in cf.scan_roots(outRoot):
+        key = sel.parse_tile(relative)
+        if key is None:
+            continue
+        dimension, mapType, x, z = key
+        groups.setdefault(f'{dimension}/{mapType}', dict())[(x, z)] = (relative, [mtime, size])
+    return groups
+
+def _read_tile(tilePath: Path):
+    # Always TILE_SIZE x TILE_SIZE, anything else gets cropped/padded with transparency
+    import numpy as np
+    from PIL import Image
+    with Image.open(tilePath) as image:
+        image = image.convert('RGBA')
+        if image.size != (TILE_SIZE, TILE_SIZE):
+            image = image.crop((0, 0, TILE_SIZE, TILE_SIZE))
+        return np.asarray(image)
+
+def _shrink(pixels, factor: int):
+    """
+    Scales a (height, width, 4) uint8 array down by factor, averaging every factor x factor block.
+    Averages with premultiplied alpha, otherwise the black of unexplored pixels bleeds into the edges of the explored ones.
+    """
+    import numpy as np
+    if factor == 1:
+        return pixels
+    height, width = pixels.shape[0] // factor, pixels.shape[1] // factor
+    rgba = pixels[:height * factor, :width * factor].astype(np.float32)
+    rgba[..., :3] *= rgba[..., 3:] / 255
+    blocks = rgba.reshape(height, factor, width, factor, 4).mean(axis=(1, 3))
+    alpha = blocks[..., 3:] / 255
+    color = np.divide(blocks[..., :3], alpha, out=np.zeros_like(blocks[..., :3]), where=alpha > 0)
+    return np.clip(np.rint(np.concatenate([color, blocks[..., 3:]], axis=-1)), 0, 255).astype(np.uint8)
+
+def build_overview(outRoot: Path, regions: dict[tuple[int, int], tuple[str, list]], outPath: Path, shrink: int = 1, preset: str = pu.DEFAULT_PRESET, workers: int | None = None):
+    """
+    Stitches all regions into one image, shrunk by shrink. The canvas is a memory-mapped file next to outPath, so the size of the world doesn't matter for the memory, only for the disk.
+    """
+    import numpy as np
+    minX, maxX = min(x for x, z in regions), max(x for x, z in regions)
+    minZ, maxZ = min(z for x, z in regions), max(z for x, z in regions)
+    side = TILE_SIZE // shrink
+    os.makedirs(str(outPath.parent), exist_ok=True)
+    tmpPath = outPath.with_name(outPath.name + '.tmp')
+    with tempfile.TemporaryDirectory(dir=outPath.parent) as tmp:
+        # A fresh file reads as zeros, so everything that's not filled in stays transparent
+        canvas = np.memmap(Path(tmp) / 'canvas', dtype=np.uint8, mode='w+', shape=((maxZ - minZ + 1) * side, (maxX - minX + 1) * side, 4))
+
+        def fill(item):
+            # Every region has its own spot on the canvas, so the threads never get in each other's way
+            (x, z), (relative, stamp) = item
+            top, left = (z - minZ) * side, (x - minX) * side
+            canvas[top:top + side, left:left + side] = _shrink(_read_tile(outRoot / relative), shrink)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(tqdm(executor.map(fill, regions.items()), total=len(regions), desc=f'Overview {outPath.parent.name}'))
+        pu.write_rgba8_streamed(tmpPath, canvas, preset)
+        # Windows can't delete the file while it's still mapped
+        del fill, canvas
+    os.replace(tmpPath, outPath)
+
+def _build_parent(tileRoot: Path, zoom: int, x: int, z: int, preset: str):
+    # A tile of a zoom level is the 4 tiles of the next level below, at half the resolution
+    import numpy as np
+    canvas = np.zeros((TILE_SIZE * 2, TILE_SIZE * 2, 4), dtype=np.uint8)
+    found = False
+    for offsetX in (0, 1):
+        for offsetZ in (0, 1):
+            childPath = tileRoot / str(zoom + 1) / str(2 * x + offsetX) / f'{2 * z + offsetZ}.png'
+            if childPath.is_file():
+                found = True
+                canvas[offsetZ * TILE_SIZE:(offsetZ + 1) * TILE_SIZE, offsetX * TILE_SIZE:(offsetX + 1) * TILE_SIZE] = _read_tile(childPath)
+    outPath = tileRoot / str(zoom) / str(x) / f'{z}.png'
+    if not found:
+        if outPath.is_file():
+            outPath.unlink()
+        return
+    os.makedirs(str(outPath.parent), exist_ok=True)
+    outPath.write_bytes(pu.encode_rgba8(_shrink(canvas, 2), preset))
+
+def pyramid_levels(regions):
+    # Enough levels that the whole group fits into one or two tiles across at zoom 0 (two if it straddles a tile border)
+    minX, maxX = min(x for x, z in regions), max(x for x, z in regions)
+    minZ, maxZ = min(z for x, z in regions), max(z for x, z in regions)
+    return math.ceil(math.log2(max(maxX - minX + 1, maxZ - minZ + 1))) + 1
+
+def update_pyramid(outRoot: Path, regions: dict[tuple[int, int], tuple[str, list]], tileRoot: Path, dirty: set[tuple[int, int]], levels: int, preset: str = pu.DEFAULT_PRESET, workers: int | None = None):
+    """
+    Brings the XYZ tiles in tileRoot/<zoom>/<x>/<z>.png up to date. The deepest zoom (levels - 1) is the regions themselves, every level above has half the resolution.
+    Only the tiles that cover a dirty region (changed, new or gone) get rebuilt.
+    """
+    maxZoom = levels - 1
+    for x, z in dirty:
+        outPath = tileRoot / str(maxZoom) / str(x) / f'{z}.png'
+        if (x, z) in regions:
+            # Hardlinked if possible, the merged tile already is exactly what we need
+            tp.place_file(outRoot / regions[(x, z)][0], outPath, 'hardlink')
+        elif outPath.is_file():
+            outPath.unlink()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for zoom in range(maxZoom - 1, -1, -1):
+            # Python's >> rounds down for negative numbers too, so -1 and -2 end up in the same parent
+            dirty = {(x >> 1, z >> 1) for x, z in dirty}
+            list(tqdm(executor.map(lambda x : _build_parent(tileRoot, zoom, *x, preset), dirty), total=len(dirty), desc=f'Zoom {zoom}', leave=False))
+
+def _load_state(exportRoot: Path):
+    empty = {'version': STATE_VERSION, 'shrink': None, 'levels': dict(), 'regions': dict()}
+    statePath = exportRoot / STATE_NAME
+    try:
+        state = json.loads(statePath.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return empty
+    return state if state.get('version') == STATE_VERSION else empty
+
+def _save_state(exportRoot: Path, state: dict):
+    statePath = exportRoot / STATE_NAME
+    tmpPath = statePath.with_name(statePath.name + '.tmp')
+    tmpPath.write_text(json.dumps(state), encoding='utf-8')
+    os.replace(tmpPath, statePath)
+
+def export(outRoot: Path, exportRoot: Path, shrink: int = 1, preset: str = pu.DEFAULT_PRESET, workers: int | None = None):
+    """
+    Exports every dimension/map type of a merged output folder to exportRoot/<dimension>/<map type>/: overview.png (shrunk by shrink) and tiles/<zoom>/<x>/<z>.png.
+    Only what changed since the last export gets redone, going by the mtime and size of the merged regions. Returns how many regions were dirty.
+    """
+    os.makedirs(str(exportRoot), exist_ok=True)
+    state = _load_state(exportRoot)
+    groups = find_regions(outRoot)
+    known: dict[str, dict] = state['regions']
+    # Regions of the last export, grouped like the current ones, so we know which ones are gone
+    previous: dict[str, set[tuple[int, int]]] = dict()
+    for relative in known:
+        key = sel.parse_tile(relative)
+        if key is not None:
+            previous.setdefault(f'{key[0]}/{key[1]}', set()).add((key[2], key[3]))
+
+    totalDirty = 0
+    for group in sorted(previous.keys() - groups.keys()):
+        # Nothing of this dimension/map type is left
+        shutil.rmtree(exportRoot / group, ignore_errors=True)
+        state['levels'].pop(group, None)
+    for group, regions in sorted(groups.items()):
+        groupRoot = exportRoot / group
+        tileRoot = groupRoot / 'tiles'
+        dirty = {position for position, (relative, stamp) in regions.items() if known.get(relative) != stamp}
+        dirty |= previous.get(group, set()) - regions.keys()
+        levels = pyramid_levels(regions)
+        if state['levels'].get(group) != levels:
+            # The world grew (or shrank) past a power of two, so every zoom level means something else now
+            shutil.rmtree(tileRoot, ignore_errors=True)
+            dirty = set(regions)
+        totalDirty += len(dirty)
+        overviewPath = groupRoot / 'overview.png'
+        if dirty or state['shrink'] != shrink or not overviewPath.is_file():
+            build_overview(outRoot, regions, overviewPath, shrink, preset, workers)
+        if dirty:
+            update_pyramid(outRoot, regions, tileRoot, dirty, levels, preset, workers)
+        state['levels'][group] = levels
+    state['shrink'] = shrink
+    state['regions'] = {relative: stamp for regions in groups.values() for relative, stamp in regions.values()}
+    _save_state(exportRoot, state)
+    return totalDirty
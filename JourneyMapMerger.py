@@ -1,56 +1,29 @@
 # This file contains the actual JourneyMap-specific merging functions, such as map merging but also Waypoint Merging
-import argparse, re, os, sys, datetime
-from pathlib import Path, PurePath
+# Importing it doesn't do anything by itself, so other scripts can use scan, plan, merge_map and merge_waypoints directly. The command line lives in main().
+import argparse, re, os, datetime, math, time
+from pathlib import Path
+from typing import TYPE_CHECKING
 import CompareFolders as cf
+import TilePlanner as tp
+import Compositing as comp
+import Manifest as mf
+import PngUtils as pu
+import ZipArchives as za
+import Scheduler as sch
+import Stats as st
+import Selection as sel
+import Export as ex
 import multiprocessing as multipr
+from concurrent.futures import Future, ThreadPoolExecutor
 from tqdm import tqdm
 
-# Requires extra packages
-import amulet.nbt as anbt
-from IPython.lib.pretty import pprint as pp
-
-# https://docs.wand-py.org/en/0.6.12/guide/draw.html#composite
-from wand.image import Image, COMPOSITE_OPERATORS
-from wand.drawing import Drawing
-
-# Sry i couldn't be bothered writing this myself so it's chatgpt
-
-# Initialize the argument parser
-parser = argparse.ArgumentParser(description="Merging of two or more JourneyMap data points. If the Map would be an art canvas, there would be a base layer, and every layer would paint on top of it, overwriting what's underneath. The layers in this case are ordered by the last edited timestamp of each individual file.")
-
-parser.add_argument("OUT", type=str, help="The folder to output the merged data to.")
-parser.add_argument("LAYER", type=str, help="The first JM Data Folder.")
-parser.add_argument("LAYERS", nargs='+', type=str, help="Any additional JM Data Folders you want to merge with the base.")
-
-parser.add_argument(
-    "--manual", 
-    action="store_true", 
-    help="Instead of ordering all files from all folders by timestamp and merging them that way, the timestamp will be disregarded and the folders will be \"layered\" on top of each other in the order that they're specified."
-)
-parser.add_argument(
-    "-w", "--waypoints", 
-    action="store_true",
-    help="Only Process Waypoints"
-)
-parser.add_argument(
-    "-m", "--map", 
-    action="store_true",
-    help="Only Process Map"
-)
-parser.add_argument(
-    "-d", "--debug", 
-    action="store_true",
-    help="Enable Debug Logs for specific scenarios (Currently only ImageMagick Child Processes)"
-)
-parser.add_argument(
-    "-y", "--yes", 
-    action="store_true",
-    help="Do not ask for confirmation before merging. Highly discouraged to be used by non-developers."
-)
-
-# Parse the command-line arguments
-args = parser.parse_args()
+# Requires extra packages. Only imported once waypoints actually get merged (and ImageMagick/numpy only once a backend gets used, see Compositing), so starting up and spawning workers stays quick.
+if TYPE_CHECKING:
+    import amulet.nbt as anbt
 
+def _amulet():
+    import amulet.nbt as anbt
+    return anbt
 
 # Coloring
 class tcol:
@@ -64,153 +37,511 @@ class tcol:
     CYAN = '\033[96m'
     FBGREEN = '\033[30;102m'
 
+class MergeOptions:
+    """
+    Everything that changes how merging works, the same things the command line flags set (with the same defaults).
+    byTime orders the layers of every map by the last modified timestamp of the files instead of the order the inputs were given in.
+    """
+    def __init__(self, byTime: bool = False, backend: str = 'wand', preset: str = pu.DEFAULT_PRESET, topDown: bool = False, singleSource: str = 'copy', checkSingle: bool = False, dedupe: bool = False, incremental: bool = False, waypointRadius: float = 0, jobs: int = 0, ioThreads: int = 4, profileDir: Path | None = None, selection: sel.Selection | None = None, memoryLimit: int | None = None):
+        self.byTime = byTime
+        self.backend = backend
+        self.preset = preset
+        self.topDown = topDown
+        self.singleSource = singleSource
+        self.checkSingle = checkSingle
+        self.dedupe = dedupe
+        self.incremental = incremental
+        self.waypointRadius = waypointRadius
+        self.jobs = jobs
+        self.ioThreads = ioThreads
+        # Where the workers dump their cProfile data, None to not profile them
+        self.profileDir = profileDir
+        # Bytes the merging processes may use together, None for no limit
+        self.memoryLimit = memoryLimit
+        # Only merge part of the world, None (or a Selection that selects everything) for all of it
+        self.selection = selection if selection is not None and not selection.everything() else None
+
+    @property
+    def shard(self):
+        # (i, N) if this is one of N shards, see Selection
+        return self.selection.shard if self.selection is not None else None
+
 ###############
 # MAP MERGING #
 ###############
 
-def layer_images_and_save(outPath: Path, *inPaths: Path):
+def layer_images(*inPaths: Path | bytes, backend: str = 'wand', topDown: bool = False, stats: dict | None = None, preset: str = pu.DEFAULT_PRESET):
     """
-    Does what it says, takes multiple images and layers them over each other. No fancy effects, just what we need.
+    Takes multiple images (paths or their bytes) and layers them over each other. Returns the finished PNG as bytes.
     """
-    os.makedirs(str(outPath.parent), exist_ok=True)
-    newFile = open(outPath, mode='+wb')
-    images: list[Image] = list()
-    for filePath in inPaths:
-        # Get File data
-        file = open(filePath, 'rb')
-        data = file.read()
-        file.close()
-        # Open image into ImageMagick 
-        images.append(Image(blob=data))
-    with Drawing() as draw:
-        # Remove the first image, that will be our bottom most image
-        first = images.pop(0)
-        first.alpha_channel = True
-        for image in images:
-            draw.composite('over', 0, 0, image.width, image.height, image)
-        # Draw the composite effects on the base image and save it
-        draw(first)
-
-        # The library used by journeymap for png writing and reading (PNGJ) is very brittle, so we need to change more parameters to make it not throw up and error out with "all rows have not been written" https://github.com/leonbloy/pngj/blob/fd2a2ea75a517b9d21d97a3b9280df3cc33572d6/src/main/java/ar/com/hjg/pngj/PngWriter.java#L283
-        # TI figured out like half of the parameters, but Gemini and ChatGPT kinda forced me to apply EVERYTHING at once which is why it now properly works
-        # NOTE: Theoretically, the map works without any of these parameters! It only becomes a problem once you try to export the map.
-        # NOTE: I feel like only one or two of these are needed, but I'm too lazy too test so imma just keep it as-is. And it doesn't cost performance either way.
-        first.strip()
-        first.compression = 'zip'
-        first.interlace_scheme = 'no'
-        first.artifacts['png:color-type'] = '6'
-        first.artifacts['png:bit-depth'] = '8'
-        first.artifacts['PNG:compression-filter'] = '0'
-        first.artifacts['PNG:format'] = 'png32'
-        first.artifacts['PNG:compression-filter'] = '0'
-        first.artifacts['PNG:compression-level'] = '9'
-        first.artifacts['PNG:compression-strategy'] = '0'
-        first.artifacts['png:exclude-chunk'] = 'all'
-        first.save(newFile)
-    newFile.close()
-
-def get_all_image_files(*roots: Path):
+    return comp.load_backend(backend)(*inPaths, topDown=topDown, stats=stats, preset=preset)
+
+def save_image(outRoot: Path | za.ZipOutput, relative: str, data: bytes):
     """
-    Gets all PNGs
+    Writes a finished image into the output folder or archive. Returns the digest of the written file and a list of reasons PNGJ would choke on it (empty if it's fine).
     """
-    files = dict()
-    if args.manual:
-        files = cf.compare(*roots)
+    if isinstance(outRoot, za.ZipOutput):
+        outRoot.write(relative, data)
     else:
-        files = cf.merge(*roots)
-    compiled = re.compile('\\.png$')
-    filesList = {key: contents for key, contents in tqdm(files.items(), desc='Getting Image Paths') if compiled.search(str(key))}
-    print(f'Total Images: {len(filesList)} ({round(len(filesList)/len(files)*100, 1)}%)')
-    return filesList
-
-def _helper_merge_images_and_save(x):
-    if x.pop(0):
-        sys.stdout = open(f'./debug_log/' + str(os.getpid()) + ".log", "w")
-    return layer_images_and_save(*x)
-
-def merge_images_and_save(outRoot: Path, images: dict[PurePath, list[Path]]):
+        outPath = outRoot / relative
+        os.makedirs(str(outPath.parent), exist_ok=True)
+        # Written under a temporary name and then swapped in, so an interrupted run never leaves a cut off map behind that the manifest would take for finished.
+        # That also replaces a hardlink to an input file from a previous run instead of writing through it.
+        tmpPath = outPath.with_name(outPath.name + '.tmp')
+        newFile = open(tmpPath, mode='wb')
+        newFile.write(data)
+        newFile.close()
+        os.replace(tmpPath, outPath)
+    return mf.digest(data), pu.pngj_problems(data)
+
+def layer_images_and_save(outPath: Path, *inPaths: Path, backend: str = 'wand', topDown: bool = False, stats: dict | None = None, preset: str = pu.DEFAULT_PRESET):
     """
-    Takes a root output path, and a dict of Paths in said root with their associated existing images. Runs this in parallel for higher performance.
+    Does what it says, takes multiple images and layers them over each other. No fancy effects, just what we need.
+    Returns the digest of the written file and a list of reasons PNGJ would choke on it (empty if it's fine).
+    """
+    return save_image(outPath.parent, outPath.name, layer_images(*inPaths, backend=backend, topDown=topDown, stats=stats, preset=preset))
+
+def scan(inRoots: list[Path], options: MergeOptions, recorder: st.Recorder | None = None):
+    """
+    Gets all PNGs of all inputs, as a TileIndex
+    """
+    recorder = recorder or st.Recorder()
+    match, descend = re.compile('\\.png$').search, None
+    if options.selection is not None:
+        # Folders of other dimensions/map types are never even listed
+        match, descend = options.selection.wants_tile, options.selection.wants_dir
+    with recorder.phase('scan'):
+        index = cf.index_files(list(inRoots), byTime=options.byTime, match=match, descend=descend)
+    print(f'Total Images: {len(index)} ({round(index.offsets[-1]/max(index.scanned, 1)*100, 1)}% of all files)')
+    return index
+
+# Set once per worker by the pool initializer, so every task only has to carry tile ids
+_workerIndex: cf.TileIndex | None = None
+_workerBackend = comp.BACKENDS['wand']
+_workerOptions = MergeOptions()
+_workerReader: ThreadPoolExecutor | None = None
+_workerDetailed = False
+_workerPrefetchBytes: int | None = None
+
+def _init_merge_worker(index: cf.TileIndex, backend: str, options: MergeOptions, detailed: bool, prefetchBytes: int | None):
+    global _workerIndex, _workerBackend, _workerOptions, _workerReader, _workerDetailed, _workerPrefetchBytes
+    _workerIndex = index
+    # Only the library of the backend that's actually used gets imported
+    _workerBackend = comp.load_backend(backend)
+    _workerOptions = options
+    _workerReader = ThreadPoolExecutor(max_workers=options.ioThreads)
+    _workerDetailed = detailed
+    _workerPrefetchBytes = prefetchBytes
+    za.forget_open_archives()
+    if options.dedupe:
+        comp.enable_decode_cache()
+    if options.profileDir is not None:
+        st.profile_worker(options.profileDir)
+
+def _timed_read(source: Path | za.ZipMember):
+    start = time.perf_counter()
+    data = source.read_bytes()
+    return data, time.perf_counter() - start
+
+def _read_ahead(tileId: int):
+    # Starts reading the layers of a tile in the background. Top-down only reads the top layer ahead, reading everything would defeat stopping early.
+    sources = _workerIndex.sources(tileId)
+    if _workerOptions.topDown:
+        return [*sources[:-1], _workerReader.submit(_timed_read, sources[-1])]
+    if _workerPrefetchBytes is None:
+        return [_workerReader.submit(_timed_read, filePath) for filePath in sources]
+    # With a memory limit, heavy tiles only get their bottom layers read ahead. The rest is read one by one while layering, the backends only ever hold one layer at a time anyway.
+    upcoming = list()
+    budget = _workerPrefetchBytes
+    for row, filePath in zip(_workerIndex.layers(tileId), sources):
+        budget -= _workerIndex.sizes[row]
+        upcoming.append(_workerReader.submit(_timed_read, filePath) if budget >= 0 or not upcoming else filePath)
+    return upcoming
+
+def _helper_merge_images(task: tuple[float, list[int]]):
+    # While one tile gets layered, the reader threads already fetch the next one from disk
+    queued, batch = task
+    info = {'pid': os.getpid(), 'queued': queued, 'start': time.time(), 'tiles': len(batch)}
+    cpu = time.process_time()
+    results = list()
+    upcoming = _read_ahead(batch[0])
+    for position, tileId in enumerate(batch):
+        start, wall = time.time(), time.perf_counter()
+        stats = comp.new_stats()
+        sources = list()
+        for source in upcoming:
+            if isinstance(source, Future):
+                source, readSeconds = source.result()
+                stats['readSeconds'] += readSeconds
+            sources.append(source)
+        readWait = time.perf_counter() - wall
+        if position + 1 < len(batch):
+            upcoming = _read_ahead(batch[position + 1])
+        data = _workerBackend(*sources, topDown=_workerOptions.topDown, stats=stats, preset=_workerOptions.preset)
+        record = None
+        if _workerDetailed:
+            record = st.new_tile_record(_workerIndex.relative(tileId), _workerIndex.layer_count(tileId), _workerIndex.layer_bytes(tileId))
+            record.update({'bytesOut': len(data), 'readWait': readWait, 'read': stats['readSeconds'], 'decode': stats['decodeSeconds'], 'composite': stats['compositeSeconds'], 'encode': stats['encodeSeconds'], 'start': start, 'end': start + time.perf_counter() - wall})
+        results.append((tileId, data, stats, record))
+    info['end'] = time.time()
+    info['cpuSeconds'] = time.process_time() - cpu
+    info['rss'] = sch.current_rss()
+    return info, results
+
+def _timed_save(outRoot: Path | za.ZipOutput, relative: str, data: bytes):
+    start, wall = time.time(), time.perf_counter()
+    outDigest, problems = save_image(outRoot, relative, data)
+    return outDigest, problems, start, time.perf_counter() - wall
+
+def merge_images_and_save(outRoot: Path | za.ZipOutput, index: cf.TileIndex, tileIds, options: MergeOptions, recorder: st.Recorder | None = None):
+    """
+    Takes a root output path, the TileIndex and the ids of the tiles that should be merged. Runs this in parallel for higher performance.
+    The workers only read and layer, writing is done by a few threads over here so the workers never wait on the disk.
+    Returns the digest of every written image by tile id.
     """
     # multipr help: https://stackoverflow.com/a/9786225
     # progressbar help: https://stackoverflow.com/a/56041325
     
-    # Setup images for execution
-    imagesList = images.items()
-    imagesList = list(map(lambda x : [args.debug, outRoot / x[0], *x[1]], imagesList))
-    # Create Pool for multiprocessing
-    pool = multipr.Pool()
-    data = pool.imap_unordered(_helper_merge_images_and_save, imagesList) # Note: You need to ask for the result of this, otherwise it won't process
-    # Create a loading bar and "ask" for the results
-    results = tqdm(data, total=len(imagesList), desc='Fusing Maps')
-    list(results) # here is the asking for results command
+    recorder = recorder or st.Recorder()
+    backend = options.backend
+    if backend == 'numpy' and not comp.numpy_available():
+        print(f'{tcol.YELLOW}numpy or Pillow is not installed, falling back to wand.{tcol.RESET}')
+        backend = 'wand'
+    jobs = options.jobs or os.cpu_count() or 1
+    governor = None
+    prefetchBytes = None
+    if options.memoryLimit is not None:
+        # Fewer workers if even the estimate says they won't fit, the governor takes care of the rest while merging
+        heaviest = max(map(lambda x : sch.tile_footprint(index, x), tileIds))
+        fitting = sch.jobs_for_memory(options.memoryLimit, jobs, heaviest)
+        if fitting < jobs:
+            print(f'{tcol.YELLOW}Only {fitting} of {jobs} workers fit into the memory limit.{tcol.RESET}')
+            jobs = fitting
+        governor = sch.MemoryGovernor(options.memoryLimit)
+        prefetchBytes = max(options.memoryLimit // jobs - sch.WORKER_BASE_BYTES - sch.DECODED_BYTES_PER_PIXEL * sch.TILE_PIXELS, 0) // 2
+
+    # Heavy tiles first, light tiles bundled into batches
+    weigh = index.layer_bytes
+    batches = sch.make_batches(sch.heaviest_first(tileIds, weigh), weigh, sch.target_weight(tileIds, weigh, jobs))
+
+    digests: dict[int, str] = dict()
+    totals = comp.new_stats()
+    invalid: dict[int, list[str]] = dict()
+    failed: list[BaseException] = list()
+
+    def written(tileId: int, record: dict | None, future: Future):
+        try:
+            outDigest, problems, start, seconds = future.result()
+        except BaseException as e:
+            failed.append(e)
+            return
+        digests[tileId] = outDigest
+        if problems:
+            invalid[tileId] = problems
+        if record is not None:
+            recorder.add_write(record, start, seconds)
+
+    # Every batch is stamped with the time it was handed to the pool, so the workers can tell how long it waited in the queue
+    tasks = map(lambda x : (time.time(), x), batches)
+    if options.profileDir is not None:
+        os.makedirs(str(options.profileDir), exist_ok=True)
+    # Create Pool for multiprocessing. The index gets sent to every worker once, the tasks are just tile ids.
+    pool = multipr.Pool(jobs, initializer=_init_merge_worker, initargs=(index, backend, options, recorder.detailed, prefetchBytes))
+    # Never more than two batches per worker waiting around, the rest stays in the generators until it's needed
+    data = sch.run_bounded(pool, _helper_merge_images, tasks, jobs * 2, governor) # Note: You need to ask for the result of this, otherwise it won't process
+    try:
+        with sch.BoundedExecutor(options.ioThreads, options.ioThreads * 4) as writer:
+            # Create a loading bar and "ask" for the results
+            with tqdm(total=len(tileIds), desc='Fusing Maps') as progress:
+                for info, results in data: # here is the asking for results command
+                    recorder.add_batch(info)
+                    if governor is not None:
+                        governor.observe(info['pid'], info['rss'])
+                    for tileId, imageData, stats, record in results:
+                        if record is not None:
+                            recorder.add_tile(record)
+                        future = writer.submit(_timed_save, outRoot, index.relative(tileId), imageData)
+                        future.add_done_callback(lambda x, tileId=tileId, record=record : written(tileId, record, x))
+                        for key, value in stats.items():
+                            totals[key] += value
+                    progress.update(len(results))
+    except BaseException:
+        # Ctrl-C or a worker crashed, don't wait for the rest. The task handler has to let go of the task generator first, otherwise terminate() waits for it forever.
+        data.close()
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    if failed:
+        raise failed[0]
 
     print(f'{tcol.GREEN}Finished processing!{tcol.RESET}')
-
-def image_get_merge_save(outRoot: Path, inRoots: list[Path]):
+    if invalid:
+        print(f'{tcol.RED}{len(invalid)} merged maps will make JourneyMap fail when exporting!{tcol.RESET} Please open an issue with these details:')
+        for tileId, problems in list(invalid.items())[:10]:
+            print(f'- {index.relative(tileId)}: {", ".join(problems)}')
+    if governor is not None and governor.throttled:
+        print(f'Held back new maps {governor.throttled} times to stay under the memory limit')
+    if options.dedupe:
+        print(f'Layers decoded from the cache: {totals["decodeCacheHits"]}')
+    if options.topDown:
+        print(f'Layers read: {totals["layersRead"]}, skipped: {totals["layersSkipped"]} ({round(totals["layersSkipped"]/max(totals["layersRead"] + totals["layersSkipped"], 1)*100, 1)}%), top layer copied as-is: {totals["topCopied"]}')
+    return digests
+
+def plan(outRoot: Path | za.ZipOutput, index: cf.TileIndex, options: MergeOptions, recorder: st.Recorder | None = None):
+    """
+    Decides what has to happen to every map of the index: nothing (incremental and unchanged), copying (single source) or compositing.
+    Returns the single source tile ids, the tile ids that need compositing and the manifest of the output folder (None for archives), as it was on disk.
+    Nothing in the output folder gets touched, so it's safe to call just to see what would be merged. With dedupe, the duplicate layers get marked in the index though (see TilePlanner.dedupe_contributors).
+    """
+    recorder = recorder or st.Recorder()
+    tileIds = index.tiles()
+    # An output archive gets written from scratch every time, so there's nothing to be incremental about
+    zipOutput = isinstance(outRoot, za.ZipOutput)
+    if zipOutput and options.incremental:
+        print(f'{tcol.YELLOW}The output is a ZIP, merging everything instead of only the changes.{tcol.RESET}')
+    if zipOutput and options.selection is not None:
+        print(f'{tcol.YELLOW}The output is a ZIP, it will only contain the selected part of the world.{tcol.RESET}')
+    with recorder.phase('plan'):
+        manifest = mf.load_manifest(outRoot, options.shard) if not zipOutput else None
+        if options.incremental and not zipOutput:
+            tileIds = mf.changed_tiles(outRoot, manifest, index, tileIds)
+            print(f'Changed: {len(tileIds)}, Unchanged: {len(index) - len(tileIds)}')
+        # Maps that only exist once don't need ImageMagick at all
+        singleSource, needsCompositing = tp.plan_tiles(index, tileIds)
+    if options.dedupe:
+        with recorder.phase('dedupe'):
+            collapsed, needsCompositing = tp.dedupe_contributors(index, needsCompositing)
+        # All inputs were the same file, so there's nothing to layer anymore
+        singleSource.extend(collapsed)
+        print(f'Duplicate layers dropped: {len(index.duplicates)}, Maps that turned into single source: {len(collapsed)}')
+    print(f'Single Source: {len(singleSource)}, Needs Compositing: {len(needsCompositing)}')
+    return singleSource, needsCompositing, manifest
+
+def merge_map(outRoot: Path | za.ZipOutput, inRoots: list[Path], options: MergeOptions, recorder: st.Recorder | None = None):
+    """
+    Merges the maps of all inputs into the output folder or archive: scan, plan, copy what can be copied and composite the rest.
+    Returns the digest of every written map by its path relative to the output (None for linked ones).
+    With incremental, outputs whose inputs are all gone get deleted. With a selection, only the selected part of the output folder and the manifest is touched.
+    As a shard, only the maps of that shard are merged, into their own manifest, and a shard report is left behind for combine_shards.
+    """
+    recorder = recorder or st.Recorder()
     print('')
     print(f'{tcol.YELLOW}-----------')
     print('MAP MERGING')
     print(f'-----------{tcol.RESET}')
     print('')
-    images = get_all_image_files(*inRoots)
-    merge_images_and_save(outRoot, images)
+    index = scan(inRoots, options, recorder)
+    singleSource, needsCompositing, manifest = plan(outRoot, index, options, recorder)
+    if manifest is not None:
+        selected = options.selection.wants_tile if options.selection is not None else None
+        with recorder.phase('manifest'):
+            if options.incremental:
+                print(f'Removed: {mf.remove_stale_outputs(outRoot, manifest, index, selected)}')
+            else:
+                # Everything (that's selected) gets rewritten, so start with a clean slate
+                mf.forget_tiles(manifest, selected)
+    with recorder.phase('single source'):
+        rejected, digests = tp.place_single_sources(outRoot, index, singleSource, options.singleSource, options.checkSingle)
+    needsCompositing.extend(rejected)
+    if needsCompositing:
+        with recorder.phase('merge'):
+            digests.update(merge_images_and_save(outRoot, index, needsCompositing, options, recorder))
+    if manifest is not None:
+        with recorder.phase('manifest'):
+            mf.record_tiles(manifest, index, digests)
+            mf.save_manifest(outRoot, manifest, options.shard)
+            if options.shard is not None:
+                mf.save_shard_report(outRoot, options.shard, inRoots, len(index), len(digests), recorder.summary())
+    return {index.relative(tileId): outDigest for tileId, outDigest in digests.items()}
+
+def combine_shards(outRoot: Path, inRoots: list[Path], options: MergeOptions, shardRoots: list[Path] | None = None, recorder: st.Recorder | None = None):
+    """
+    Puts the results of a sharded merge together in outRoot. shardRoots are the output folders the shards wrote into, by default just outRoot.
+    Checks every shard finished and every map of the inputs is there and up to date, then joins the shard manifests into the one of outRoot and gathers the shard stats into recorder.
+    Maps of shards in other folders get hardlinked (or copied) over. Returns the list of maps that are missing or outdated, empty if everything's complete.
+    """
+    recorder = recorder or st.Recorder()
+    shardRoots = shardRoots or [outRoot]
+    print('')
+    print(f'{tcol.YELLOW}---------------')
+    print('COMBINING SHARDS')
+    print(f'---------------{tcol.RESET}')
+    print('')
+    with recorder.phase('combine'):
+        found: dict[tuple[int, int], tuple[Path, dict]] = dict()
+        for root in shardRoots:
+            for report in mf.load_shard_reports(root):
+                found[tuple(report['shard'])] = (root, report)
+        counts = {count for index, count in found}
+        if len(counts) != 1:
+            print(f'{tcol.RED}Found shard reports for {len(counts)} different shard counts, expected exactly one.{tcol.RESET} Remove the reports (and manifests) of old sharded runs.')
+            return [f'shard ?/{count}' for count in sorted(counts)] or ['shard ?/?']
+        count = counts.pop()
+        unfinished = [f'shard {index}/{count}' for index in range(count) if (index, count) not in found]
+        if unfinished:
+            print(f'{tcol.RED}Not every shard has finished:{tcol.RESET} {", ".join(unfinished)}')
+            return unfinished
+        # The combined manifest has to cover the same part of the world the shards did
+        index = scan(inRoots, options, recorder)
+        manifest = mf.load_manifest(outRoot)
+        for shard, (root, report) in sorted(found.items()):
+            print(f'- Shard {shard[0]}/{shard[1]} on {report["host"]}: {report["tiles"]} maps, {report["written"]} written, took {sum(phase["seconds"] for phase in report["stats"]["phases"].values()):.2f}s')
+            recorder.add_shard(report)
+            for relative, entry in mf.load_manifest(root, shard)['tiles'].items():
+                if root != outRoot and (root / relative).is_file():
+                    tp.place_file(root / relative, outRoot / relative, 'hardlink')
+                manifest['tiles'][relative] = entry
+        # Outputs whose inputs are gone were already deleted by the shards themselves, just forget them
+        current = set(index.paths)
+        selected = options.selection.wants_tile if options.selection is not None else None
+        mf.forget_tiles(manifest, lambda x : x not in current and (selected is None or selected(x)))
+        missing = list()
+        for tileId in index.tiles():
+            relative = index.relative(tileId)
+            entry = manifest['tiles'].get(relative)
+            if entry is None or entry['sources'] != index.stamps(tileId) or not (outRoot / relative).is_file():
+                missing.append(relative)
+        if missing:
+            print(f'{tcol.RED}{len(missing)} maps are missing or outdated{tcol.RESET}, run their shards again (with -i only they get redone). The first few:')
+            for relative in missing[:10]:
+                print(f'- {relative} (shard {sel.shard_of(relative, count)}/{count})')
+            return missing
+        mf.save_manifest(outRoot, manifest)
+    print(f'{tcol.GREEN}All {count} shards are complete!{tcol.RESET} {len(index)} maps')
+    return missing
 
 ####################
 # WAYPOINT MERGING #
 ####################
 type nbtDataStoreStuff = anbt.CompoundTag[anbt.CompoundTag]
 
-def get_waypoints(*inputRoots: Path):
-    if args.manual:
+def _waypoint_file(root: Path):
+    # WaypointData.dat of a root, None if it doesn't have one
+    if za.is_zip(root):
+        return za.member(root, 'waypoints/WaypointData.dat')
+    nbtPath = root / 'waypoints' / 'WaypointData.dat'
+    return nbtPath if nbtPath.is_file() else None
+
+def get_waypoints(*inputRoots: Path, byTime: bool = False):
+    if byTime:
         # By time
-        inputRootsDict: dict[Path, float] = dict()
+        inputRootsDict: dict[Path | za.ZipMember, float] = dict()
         for root in inputRoots:
-            nbtPath = root / 'waypoints' / 'WaypointData.dat'
-            if nbtPath.is_file():
-                inputRootsDict[os.path.getmtime(str(nbtPath))] = nbtPath
-        inputRootsDict = dict(sorted(inputRootsDict.items()))
-        inputFiles: list[Path] = list(map(lambda x : x[0], inputRootsDict))
+            nbtPath = _waypoint_file(root)
+            if nbtPath is not None:
+                inputRootsDict[nbtPath] = mf.stamp(nbtPath)[1]
+        inputFiles: list[Path | za.ZipMember] = sorted(inputRootsDict, key=inputRootsDict.get)
     else:
         # By manual order
-        inputFiles: list[Path] = list()
+        inputFiles: list[Path | za.ZipMember] = list()
         for root in inputRoots:
-            nbtPath = root / 'waypoints' / 'WaypointData.dat'
-            if nbtPath.is_file():
+            nbtPath = _waypoint_file(root)
+            if nbtPath is not None:
                 inputFiles.append(nbtPath)
     return inputFiles
 
-def merge_waypoint_data_and_save(outFilePath: Path | list[Path], *inputFiles: Path):
+def _read_waypoint_file(file: Path | za.ZipMember):
+    anbt = _amulet()
+    return anbt.read_nbt(filepath_or_buffer=file.read_bytes(), preset=anbt.java_encoding)
+
+def _tag_number(tag):
+    # Numeric NBT tags all know how to turn into a Python number, they just call it differently
+    for attribute in ('py_float', 'py_int', 'py_data'):
+        if hasattr(tag, attribute):
+            return float(getattr(tag, attribute))
+    return float(tag)
+
+def _waypoint_location(waypoint):
+    """
+    Returns (dimension, x, y, z) of a waypoint, or None if it doesn't look like one we understand. Those are never deduplicated.
+    Different JourneyMap versions store this differently, so a few layouts are tried.
     """
-    Takes the WaypointData.dat files from the given Roots, merges them and writes the output.
+    dimension = None
+    for key in ('primaryDimension', 'dimension', 'dim'):
+        if key in waypoint:
+            dimension = str(waypoint[key].py_str if hasattr(waypoint[key], 'py_str') else waypoint[key])
+            break
+    if dimension is None and 'dimensions' in waypoint and len(waypoint['dimensions']) > 0:
+        first = waypoint['dimensions'][0]
+        dimension = str(first.py_str if hasattr(first, 'py_str') else first)
+    for container in (waypoint, waypoint.get('pos'), waypoint.get('position')):
+        if container is not None and all(axis in container for axis in ('x', 'y', 'z')):
+            return dimension, *(_tag_number(container[axis]) for axis in ('x', 'y', 'z'))
+    return None
+
+def dedupe_waypoints(waypoints: nbtDataStoreStuff, timeOf: dict[str, float], radius: float):
     """
-    # Read Data
+    Collapses waypoints of the same dimension that are within radius blocks of each other into one.
+    timeOf is the last modified time of the WaypointData.dat every waypoint came from. The winner is the one from the newest file, no matter the order of the inputs. With the same time, the one with the smallest key wins, so the result never depends on the order the files were read in.
+    Uses a spatial hash with cells of radius size, so only the neighbouring cells have to be checked. Returns how many waypoints were removed.
+    """
+    ranked = sorted(timeOf, key=lambda x : (-timeOf[x], x))
+    cells: dict[tuple, list[tuple[float, float, float]]] = dict()
+    removed = 0
+    for key in ranked:
+        location = _waypoint_location(waypoints[key])
+        if location is None:
+            continue
+        dimension, x, y, z = location
+        cellX, cellZ = math.floor(x / radius), math.floor(z / radius)
+        duplicate = False
+        for neighbourX in (cellX - 1, cellX, cellX + 1):
+            for neighbourZ in (cellZ - 1, cellZ, cellZ + 1):
+                for keptX, keptY, keptZ in cells.get((dimension, neighbourX, neighbourZ), ()):
+                    if (keptX - x) ** 2 + (keptY - y) ** 2 + (keptZ - z) ** 2 <= radius ** 2:
+                        duplicate = True
+                        break
+        if duplicate:
+            del waypoints[key]
+            removed += 1
+        else:
+            cells.setdefault((dimension, cellX, cellZ), list()).append((x, y, z))
+    return removed
+
+def merge_waypoint_data_and_save(outFilePath: Path | list[Path], *inputFiles: Path | za.ZipMember, dedupRadius: float = 0):
+    """
+    Takes the WaypointData.dat files from the given Roots, merges them and writes the output. Returns the written data.
+    Later files win if the same waypoint or group exists in multiple files. If dedupRadius is set, waypoints that are closer than that to each other are merged into one as well.
+    """
+    # Read Data, all files at once. The parsing itself holds the GIL, but reading the next files overlaps with it.
     print('(1) Reading WaypointData.dat files')
-    nbtDataList: list[anbt.NamedTag[nbtDataStoreStuff]] = list()
-    for file in tqdm(inputFiles):
-        nbtDataList.append(anbt.read_nbt(filepath_or_buffer=file.read_bytes(), preset=anbt.java_encoding))
+    with ThreadPoolExecutor(max_workers=min(len(inputFiles), 8) or 1) as executor:
+        nbtDataList: list[anbt.NamedTag[nbtDataStoreStuff]] = list(tqdm(executor.map(_read_waypoint_file, inputFiles), total=len(inputFiles)))
 
-    # Merge Data, overwrite existing stuff
+    # Merge Data, overwrite existing stuff. One pass over every waypoint and group of every file.
     nbtBase = nbtDataList.pop(0)
     nbtBaseWaypoints: nbtDataStoreStuff = nbtBase[1]['waypoints'] # NOTE: These should be pointers. If you notice the output NBT to be the same as the oldest/first Waypoint file, then this is not a pointer for some reason.
-    print('(2) Merging Data')
     nbtBaseGroups: nbtDataStoreStuff = nbtBase[1]['groups']
-    for nbtData in tqdm(nbtDataList, leave=True, position=0):
-        nbtDataWaypoints: nbtDataStoreStuff = nbtData[1]['waypoints']
-        nbtDataGroups: nbtDataStoreStuff = nbtData[1]['groups']
-
-        # Waypoint Merging
-        for key, value in tqdm(nbtDataWaypoints.items(), desc='Waypoints', leave=False, position=1): # Does not provide value for some reason?
-            nbtBaseWaypoints[key] = value
-
-        # Waypoint Group Merging
-        for key, value in tqdm(nbtDataGroups.items(), desc='Groups', leave=False, position=1):
-            nbtBaseGroups[key] = value
+    print('(2) Merging Data')
+    # How recent the file every waypoint came from is, the newest one wins when deduplicating
+    fileTimes = list(map(lambda x : mf.stamp(x)[1], inputFiles))
+    timeOf: dict[str, float] = {key: fileTimes[0] for key in nbtBaseWaypoints.keys()}
+    counts = {'waypoints': len(timeOf), 'waypointsReplaced': 0, 'groups': len(nbtBaseGroups), 'groupsReplaced': 0, 'deduplicated': 0}
+    total = sum(map(lambda x : len(x[1]['waypoints']) + len(x[1]['groups']), nbtDataList))
+    with tqdm(total=total, desc='Waypoints and Groups') as progress:
+        for layer, nbtData in enumerate(nbtDataList, start=1):
+            for key, value in nbtData[1]['waypoints'].items():
+                counts['waypointsReplaced' if key in nbtBaseWaypoints else 'waypoints'] += 1
+                nbtBaseWaypoints[key] = value
+                timeOf[key] = fileTimes[layer]
+            for key, value in nbtData[1]['groups'].items():
+                counts['groupsReplaced' if key in nbtBaseGroups else 'groups'] += 1
+                nbtBaseGroups[key] = value
+            progress.update(len(nbtData[1]['waypoints']) + len(nbtData[1]['groups']))
+
+    if dedupRadius > 0:
+        counts['deduplicated'] = dedupe_waypoints(nbtBaseWaypoints, timeOf, dedupRadius)
+    print(f'Waypoints: {counts["waypoints"] - counts["deduplicated"]} ({counts["waypointsReplaced"]} replaced by newer ones, {counts["deduplicated"]} duplicates removed)')
+    print(f'Groups: {counts["groups"]} ({counts["groupsReplaced"]} replaced by newer ones)')
 
     # Save data in new directory
     print('(3) Saving Data')
-    final = nbtBase.to_nbt(compressed=False, little_endian=False, string_encoding=anbt.mutf8_encoding) # NOTE: Saving compressed makes JourneyMap label it "corrupted"
-    if outFilePath.__class__ == Path:
+    final = nbtBase.to_nbt(compressed=False, little_endian=False, string_encoding=_amulet().mutf8_encoding) # NOTE: Saving compressed makes JourneyMap label it "corrupted"
+    # Path() makes a PosixPath/WindowsPath, so comparing the class with Path itself never matches
+    if isinstance(outFilePath, Path):
         outFilePath = [outFilePath]
     outFilePathList: list[Path] = outFilePath
 
@@ -220,19 +551,58 @@ def merge_waypoint_data_and_save(outFilePath: Path | list[Path], *inputFiles: Pa
         file.write(final)
         file.close()
     print(f'{tcol.GREEN}Saving Done!{tcol.RESET}')
+    return final
 
-def waypoint_get_merge_save(outRoot: Path, inRoots: list[Path]):
+def merge_waypoints(outRoot: Path | za.ZipOutput, inRoots: list[Path], options: MergeOptions, recorder: st.Recorder | None = None):
+    """
+    Merges the WaypointData.dat of all inputs into the output folder or archive. Returns the written data, or None if it was skipped because nothing changed.
+    """
+    recorder = recorder or st.Recorder()
     print('')
     print(f'{tcol.CYAN}---------------------')
     print('MERGING WAYPOINT DATA')
     print(f'---------------------{tcol.RESET}')
     print('')
+    with recorder.phase('waypoints'):
+        return _waypoint_merge_save(outRoot, get_waypoints(*inRoots, byTime=options.byTime), options)
+
+def _waypoint_merge_save(outRoot: Path | za.ZipOutput, ins: list[Path | za.ZipMember], options: MergeOptions):
+    if isinstance(outRoot, za.ZipOutput):
+        final = merge_waypoint_data_and_save([], *ins, dedupRadius=options.waypointRadius)
+        outRoot.write('waypoints/WaypointData.dat', final)
+        outRoot.write('waypoints/backup/WaypointData.dat', final)
+        return final
     outs = [
         outRoot / 'waypoints' / 'WaypointData.dat',
         outRoot / 'waypoints' / 'backup' / 'WaypointData.dat'
     ]
-    ins = get_waypoints(*inRoots)
-    merge_waypoint_data_and_save(outs, *ins)
+    manifest = mf.load_manifest(outRoot)
+    stamps = list(map(mf.stamp, ins))
+    previous = manifest['waypoints']
+    if options.incremental and previous is not None and previous['sources'] == stamps and previous.get('radius') == options.waypointRadius and all(map(lambda x : x.is_file(), outs)):
+        print('No WaypointData.dat changed since the last run, skipping')
+        return None
+    final = merge_waypoint_data_and_save(outs, *ins, dedupRadius=options.waypointRadius)
+    manifest['waypoints'] = {'sources': stamps, 'digest': mf.digest(final), 'radius': options.waypointRadius}
+    mf.save_manifest(outRoot, manifest)
+    return final
+
+def export_map(outRoot: Path, exportRoot: Path, shrink: int = 1, preset: str = pu.DEFAULT_PRESET, recorder: st.Recorder | None = None):
+    """
+    Writes an overview image and a zoom pyramid for web maps of every dimension and map type of a merged output folder to exportRoot, see Export.
+    """
+    recorder = recorder or st.Recorder()
+    print('')
+    print(f'{tcol.CYAN}----------------')
+    print('EXPORTING MAP')
+    print(f'----------------{tcol.RESET}')
+    print('')
+    if not ex.available():
+        print(f'{tcol.YELLOW}Exporting needs numpy and Pillow (pip install numpy pillow), skipping{tcol.RESET}')
+        return
+    with recorder.phase('export'):
+        dirty = ex.export(outRoot, exportRoot, shrink, preset)
+    print(f'{tcol.GREEN}Export done!{tcol.RESET} {dirty} regions were new or changed')
 
 def getUserYesNo():
     while True:
@@ -255,7 +625,184 @@ def getUserYesNo():
             case _:
                 print('Try again.')
 
-if __name__ == '__main__':
+def build_parser():
+    # Sry i couldn't be bothered writing this myself so it's chatgpt
+
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description="Merging of two or more JourneyMap data points. If the Map would be an art canvas, there would be a base layer, and every layer would paint on top of it, overwriting what's underneath. The layers in this case are ordered by the last edited timestamp of each individual file.")
+
+    parser.add_argument("OUT", type=str, help="The folder to output the merged data to. If it ends with .zip, a ZIP archive ready for JourneyMap's import gets written instead.")
+    parser.add_argument("LAYER", type=str, help="The first JM Data Folder, or a ZIP exported by JourneyMap.")
+    parser.add_argument("LAYERS", nargs='+', type=str, help="Any additional JM Data Folders (or ZIPs) you want to merge with the base.")
+
+    parser.add_argument(
+        "--manual", 
+        action="store_true", 
+        help="Instead of ordering all files from all folders by timestamp and merging them that way, the timestamp will be disregarded and the folders will be \"layered\" on top of each other in the order that they're specified."
+    )
+    parser.add_argument(
+        "-w", "--waypoints", 
+        action="store_true",
+        help="Only Process Waypoints"
+    )
+    parser.add_argument(
+        "-m", "--map", 
+        action="store_true",
+        help="Only Process Map"
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print where the time went at the end: every phase, every worker, how long reading/decoding/layering/encoding/writing the maps took, a latency histogram and the slowest maps."
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="FOLDER",
+        help="Same as --stats, and also write a timeline (trace.json, open it in chrome://tracing or ui.perfetto.dev), the numbers as stats.json and a cProfile dump per worker (worker-<pid>.prof) into this folder."
+    )
+    parser.add_argument(
+        "--single-source",
+        choices=tp.LINK_MODES,
+        default='copy',
+        help="How maps that only exist in one input get put into the output. They don't need any merging, so they're copied by default. \"hardlink\" and \"reflink\" save disk space and time, but a hardlinked output shares the file with the input, so don't edit one unless you're fine with the other changing too. Falls back to copying if linking is not possible."
+    )
+    parser.add_argument(
+        "--check-single",
+        action="store_true",
+        help="Check every single source map once to see if JourneyMap can export it. Maps that fail the check are re-encoded with ImageMagick instead of being copied."
+    )
+    parser.add_argument(
+        "--backend",
+        choices=list(comp.BACKENDS),
+        default='wand',
+        help="What does the actual layering of the maps. \"wand\" uses ImageMagick, \"numpy\" does it in Python itself and is a lot faster, but needs numpy and Pillow installed (pip install numpy pillow). Falls back to wand if those are missing."
+    )
+    parser.add_argument(
+        "-p", "--preset",
+        choices=list(pu.PRESETS),
+        default=pu.DEFAULT_PRESET,
+        help="How hard to compress merged maps. \"classic\" (default) is what this script always did. \"fast\" and \"balanced\" are quicker to write but the files get a bit bigger, \"smallest\" squeezes out a few more percent but takes about 10 times as long. Every merged map is checked to be readable by JourneyMap no matter the preset."
+    )
+    parser.add_argument(
+        "--top-down",
+        action="store_true",
+        help="Layer the maps starting with the newest one and stop reading older maps as soon as every pixel is covered. Same result, but a lot less reading and decoding when the newer maps are fully explored."
+    )
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="Look for maps that are exact copies of each other in different inputs (backups, the same world exported twice, ...) and only layer one of them. If all inputs of a map turn out to be the same file, it just gets copied. Only files of the same size get compared, so this is cheap."
+    )
+    parser.add_argument(
+        "--dimension",
+        action="append",
+        help="Only merge the maps of this dimension, the folder name like overworld or the_nether. Can be given multiple times or comma separated. Everything else in the output folder stays as it is. Like with all of the selection flags (--type, --region-bbox, --radius), waypoints are left alone too unless -w is given."
+    )
+    parser.add_argument(
+        "--type",
+        action="append",
+        help="Only merge this map type: day, night, topo, biome, caves (all cave layers) or caves/<layer>. Can be given multiple times or comma separated."
+    )
+    parser.add_argument(
+        "--region-bbox",
+        type=sel.bbox,
+        metavar="MINX,MINZ,MAXX,MAXZ",
+        help="Only merge the regions in this box, in region coordinates (the numbers in the map file names, one region is 512x512 blocks). Both corners are included. If it starts with a minus, write it as --region-bbox=-10,-10,10,10"
+    )
+    parser.add_argument(
+        "--radius",
+        type=sel.circle,
+        metavar="X,Z,BLOCKS",
+        help="Only merge the regions within this many blocks of the block coordinates X,Z. Great for quickly refreshing the area around spawn. If X is negative, write it as --radius=-100,50,1000"
+    )
+    parser.add_argument(
+        "-i", "--incremental",
+        action="store_true",
+        help="Only merge what changed since the last run into the same output folder. Every run leaves a manifest (" + mf.MANIFEST_NAME + ") in the output folder that remembers which input files went into which output file. Outputs whose inputs are all gone get deleted."
+    )
+    parser.add_argument(
+        "--waypoint-radius",
+        type=float,
+        default=0,
+        help="Merge waypoints in the same dimension that are at most this many blocks apart into one, keeping the one from the most recently changed WaypointData.dat. Useful if everyone has their own \"home\" waypoint at the same spot. 0 (default) turns it off."
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=0,
+        help="How many maps get merged at the same time. Defaults to the number of CPU cores."
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=4,
+        help="How many threads read and write files next to the merging. Raise it for network shares, lower it for a single slow HDD."
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=sch.parse_size,
+        metavar="SIZE",
+        help="How much memory the merging may use in total, like 8G or 500M. Uses fewer workers if they wouldn't fit, holds back new maps while the workers use too much (measured on Linux, estimated elsewhere) and stops reading huge maps ahead."
+    )
+    parser.add_argument(
+        "--shard",
+        type=sel.shard,
+        metavar="I/N",
+        help="Only merge the I-th of N equal parts of the maps (counting from 0), so N processes or machines can merge at the same time, into the same output folder or separate ones. Every machine needs to see the inputs under the same paths. Waypoints are left for --combine."
+    )
+    parser.add_argument(
+        "--combine",
+        nargs="*",
+        metavar="SHARD_OUT",
+        help="Run this after all shards are done, with the same inputs and selection flags as the shards. Checks every map got merged, joins the shard manifests and stats, copies the maps of shards that wrote to other folders (the SHARD_OUT folders, none means they all wrote into OUT) and merges the waypoints."
+    )
+    parser.add_argument(
+        "--export",
+        type=str,
+        metavar="FOLDER",
+        help="After merging, also write the map to FOLDER as one overview.png per dimension and map type and as tiles/<zoom>/<x>/<y>.png for web maps like Leaflet. Running it again into the same folder only redoes the parts whose maps changed. Needs numpy and Pillow, doesn't work with ZIP outputs."
+    )
+    parser.add_argument(
+        "--overview-shrink",
+        type=int,
+        choices=[1, 2, 4, 8, 16, 32],
+        default=1,
+        help="Make the overview images this many times smaller. 1 (default) is one pixel per block, which gets huge quickly for big worlds."
+    )
+    parser.add_argument(
+        "-y", "--yes", 
+        action="store_true",
+        help="Do not ask for confirmation before merging. Highly discouraged to be used by non-developers."
+    )
+    return parser
+
+def options_from_args(args: argparse.Namespace):
+    return MergeOptions(
+        # NOTE: --manual has always turned on ordering by time, kept that way so nobody's scripts suddenly merge differently
+        byTime=args.manual,
+        backend=args.backend,
+        preset=args.preset,
+        topDown=args.top_down,
+        singleSource=args.single_source,
+        checkSingle=args.check_single,
+        dedupe=args.dedupe,
+        incremental=args.incremental,
+        waypointRadius=args.waypoint_radius,
+        jobs=args.jobs,
+        ioThreads=args.io_threads,
+        profileDir=Path(args.profile) if args.profile else None,
+        memoryLimit=args.memory_limit,
+        selection=sel.Selection(sel.split_list(args.dimension), sel.split_list(args.type), args.region_bbox, args.radius, args.shard),
+    )
+
+def main(argv: list[str] | None = None):
+    # Parse the command-line arguments
+    args = build_parser().parse_args(argv)
+    options = options_from_args(args)
+    # Phases are always timed, the per map numbers are only collected if someone wants to see them
+    recorder = st.Recorder(detailed=args.stats or args.profile is not None)
+
     outPath = Path(args.OUT)
     inputPaths = [Path(args.LAYER), *map(lambda x : Path(x), args.LAYERS)]
     processedFlag = False
@@ -264,8 +811,10 @@ if __name__ == '__main__':
 
     print('')
 
-    # Check if given paths are valid directories
+    # Check if given paths are valid directories (or archives)
     for uwu in inputPaths:
+        if za.is_zip(uwu) and uwu.is_file():
+            continue
         if not uwu.is_dir():
             safeToContinue = False
             if not uwu.exists():
@@ -281,11 +830,19 @@ if __name__ == '__main__':
         print('- Accidental Escaping. Backslash (\\) is used for escaping characters, and Windows Paths include those. Escaping means a quote like " or \' looses it\'s meaning as "End of text". Even the Python provided sys.argv cannot deal with them. To prevent escaping, replace \\ with \\\\, as this escapes the escape. You should also remove the trailing \\ at the end of paths')
         exit(1)
 
-    if outPath.is_file():
+    if outPath.is_file() and not za.is_zip(outPath):
         safeToContinue = True
         print(f'{tcol.RED}Output path is a file.{tcol.RESET} Use a different path or delete it first.')
         exit(1)
 
+    if (args.shard is not None or args.combine is not None) and za.is_zip(outPath):
+        # A ZIP can only be written by one process, and only from scratch
+        print(f'{tcol.RED}--shard and --combine only work with output folders, not archives.{tcol.RESET}')
+        exit(1)
+    if args.shard is not None and args.combine is not None:
+        print(f'{tcol.RED}--shard and --combine can\'t be used together.{tcol.RESET} Run the shards first, then combine them.')
+        exit(1)
+
     # Check if given paths are only ever given ONCE.
     allPaths = [outPath, *inputPaths]
     duplicatePaths = set()
@@ -320,6 +877,12 @@ if __name__ == '__main__':
             if not getUserYesNo():
                 print('Cancelling!')
                 exit(0)
+        if outPath.is_file():
+            print('')
+            print(f'The output archive already exists! Are you sure you want to {tcol.RED}overwrite and permanently delete it?{tcol.RESET}')
+            if not getUserYesNo():
+                print('Cancelling!')
+                exit(0)
 
         # We will merge these things btw
         print('')
@@ -330,7 +893,8 @@ if __name__ == '__main__':
             print('- Waypoints (including Groups)')
         if (args.map == False and args.waypoints == False):
             print('- World Map')
-            print('- Waypoints (including Groups)')
+            if options.selection is None:
+                print('- Waypoints (including Groups)')
         
         print('')
         print(f'This is your {tcol.YELLOW}last confirmation{tcol.RESET} that everything you specified is correct. After that the script will run as expected.')
@@ -342,21 +906,61 @@ if __name__ == '__main__':
 
     print('All good, starting the merging process... (spam Ctrl-C to cancel)')
     os.makedirs(str(outPath.parent), exist_ok=True)
-    if args.debug:
-        os.makedirs(f'./debug_log/', exist_ok=True)
-
-    # Go through flags
-    if args.map:
-        processedFlag = True
-        image_get_merge_save(outPath, inputPaths)
-    if args.waypoints:
-        processedFlag = True
-        waypoint_get_merge_save(outPath, inputPaths)
-
-    # If none of the flags were set, nothing would have been processed, so here comes the default behaviour
-    if not processedFlag:
-        image_get_merge_save(outPath, inputPaths)
-        waypoint_get_merge_save(outPath, inputPaths)
+    # Archives are streamed into while merging, nothing gets extracted or zipped up afterwards
+    outTarget = za.ZipOutput(outPath) if za.is_zip(outPath) else outPath
+
+    try:
+        if args.combine is not None:
+            # The maps were already merged by the shards, only the waypoints are left
+            missing = combine_shards(outTarget, inputPaths, options, list(map(lambda x : Path(x), args.combine)), recorder)
+            if missing:
+                exit(3)
+            if args.waypoints or (not args.map and options.selection is None):
+                merge_waypoints(outTarget, inputPaths, options, recorder)
+            elif not args.map:
+                print(f'{tcol.YELLOW}Only part of the world was selected, leaving the waypoints alone.{tcol.RESET} Add -w to merge them anyway.')
+            processedFlag = True
+        elif args.shard is not None:
+            if args.waypoints and not args.map:
+                print(f'{tcol.YELLOW}Shards don\'t merge waypoints, that happens once in --combine.{tcol.RESET}')
+            else:
+                merge_map(outTarget, inputPaths, options, recorder)
+            processedFlag = True
+        else:
+            # Go through flags
+            if args.map:
+                processedFlag = True
+                merge_map(outTarget, inputPaths, options, recorder)
+            if args.waypoints:
+                processedFlag = True
+                merge_waypoints(outTarget, inputPaths, options, recorder)
+
+            # If none of the flags were set, nothing would have been processed, so here comes the default behaviour
+            if not processedFlag:
+                merge_map(outTarget, inputPaths, options, recorder)
+                # Waypoints are one file for the whole world, a --dimension/--type/... run shouldn't rewrite them behind your back
+                if options.selection is None:
+                    merge_waypoints(outTarget, inputPaths, options, recorder)
+                else:
+                    print('')
+                    print(f'{tcol.YELLOW}Only part of the world was selected, leaving the waypoints alone.{tcol.RESET} Add -w to merge them anyway.')
+    finally:
+        if isinstance(outTarget, za.ZipOutput):
+            outTarget.close()
+
+    if args.export:
+        if isinstance(outTarget, za.ZipOutput):
+            print(f'{tcol.YELLOW}--export only works with output folders, not archives. Skipping the export.{tcol.RESET}')
+        elif args.shard is not None:
+            print(f'{tcol.YELLOW}A shard only has part of the map, export after --combine instead.{tcol.RESET}')
+        elif args.map or args.combine is not None or not processedFlag:
+            export_map(outPath, Path(args.export), args.overview_shrink, options.preset, recorder)
+
+    if recorder.detailed:
+        recorder.print_summary()
+    if args.profile:
+        recorder.save(Path(args.profile))
+        print(f'Timeline and stats written to {args.profile}')
     
     print('')
     print(f"{tcol.FBGREEN}================{tcol.RESET}")
@@ -368,4 +972,7 @@ if __name__ == '__main__':
     print("If it was actually successful is something you have to check yourself. This script did what we told it to do, so now it's your due diligence to check it did everything as you want it to be done.")
     print("ALWAYS KEEP BACKUPS. ALWAYS.")
     print("WE HAVE NO LIABILITY IF IT WASN'T ABLE TO MERGE. But if it did fail, please open an issue on GitHub with all relevant details, thanks!")
-    print('')
\ No newline at end of file
+    print('')
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,123 @@
+# Keeps track of what went into every output file, so a re-run only has to redo the files whose inputs actually changed
+import hashlib, json, os, socket, time
+from array import array
+from pathlib import Path, PurePath
+import CompareFolders as cf
+import ZipArchives as za
+
+# Lives in the root of the output folder. JourneyMap ignores files it doesn't know.
+MANIFEST_NAME = '.journeymap-merger-manifest.json'
+MANIFEST_VERSION = 1
+# Every shard leaves one of these next to its own manifest once it's done, see --shard and --combine
+SHARD_REPORT_PREFIX = '.journeymap-merger-shard-'
+
+# A stamp is [absolute path, mtime, size]. If any of these change we assume the file changed.
+type Stamp = list
+
+def digest(data: bytes):
+    return hashlib.sha1(data).hexdigest()
+
+def stamp(filePath: Path | za.ZipMember):
+    if isinstance(filePath, za.ZipMember):
+        return za.stamp(filePath)
+    stat = filePath.stat()
+    return [str(filePath), stat.st_mtime, stat.st_size]
+
+def manifest_name(shard: tuple[int, int] | None = None):
+    # Shards get a manifest each, they might all write into the same output folder at the same time
+    if shard is None:
+        return MANIFEST_NAME
+    return f'{MANIFEST_NAME[:-len(".json")]}.shard-{shard[0]}-of-{shard[1]}.json'
+
+def load_manifest(outRoot: Path, shard: tuple[int, int] | None = None):
+    """
+    Reads the manifest of the output folder (or the one of a shard). Returns an empty one if there is none yet, or if it's from an incompatible version or broken.
+    """
+    empty = {'version': MANIFEST_VERSION, 'tiles': dict(), 'waypoints': None}
+    manifestPath = outRoot / manifest_name(shard)
+    if not manifestPath.is_file():
+        return empty
+    try:
+        manifest = json.loads(manifestPath.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        print(f'Manifest {str(manifestPath)} is unreadable, treating everything as changed')
+        return empty
+    if manifest.get('version') != MANIFEST_VERSION:
+        return empty
+    return manifest
+
+def save_manifest(outRoot: Path, manifest: dict, shard: tuple[int, int] | None = None):
+    os.makedirs(str(outRoot), exist_ok=True)
+    manifestPath = outRoot / manifest_name(shard)
+    # Write to a temporary file first, so Ctrl-C can't leave a half written manifest behind
+    tmpPath = manifestPath.with_name(manifestPath.name + '.tmp')
+    tmpPath.write_text(json.dumps(manifest), encoding='utf-8')
+    os.replace(tmpPath, manifestPath)
+
+def changed_tiles(outRoot: Path, manifest: dict, index: cf.TileIndex, tileIds):
+    """
+    Returns only the tiles that have to be merged again: new tiles, tiles whose contributors or their stamps changed and tiles whose output went missing.
+    The order of the stamps is the layer order, so reordered layers count as a change too.
+    """
+    known: dict[str, dict] = manifest['tiles']
+    changed = array('q')
+    for tileId in tileIds:
+        relative = index.relative(tileId)
+        entry = known.get(relative)
+        if entry is None or entry['sources'] != index.stamps(tileId) or not (outRoot / relative).is_file():
+            changed.append(tileId)
+    return changed
+
+def remove_stale_outputs(outRoot: Path, manifest: dict, index: cf.TileIndex, selected = None):
+    """
+    Deletes outputs we made in an earlier run whose sources are all gone now. Files we never made are left alone.
+    If only part of the world was scanned, pass selected (a function that gets the relative path) so outputs outside of that part aren't mistaken for stale ones.
+    """
+    current = set(index.paths)
+    stale = [key for key in manifest['tiles'] if key not in current and (selected is None or selected(key))]
+    for key in stale:
+        outPath = outRoot / PurePath(key)
+        if outPath.is_file():
+            outPath.unlink()
+        del manifest['tiles'][key]
+    return len(stale)
+
+def forget_tiles(manifest: dict, selected = None):
+    """
+    Forgets the tiles that are about to be rewritten from scratch, all of them or only the selected ones.
+    """
+    if selected is None:
+        manifest['tiles'] = dict()
+    else:
+        manifest['tiles'] = {key: entry for key, entry in manifest['tiles'].items() if not selected(key)}
+
+def record_tiles(manifest: dict, index: cf.TileIndex, digests: dict[int, str | None]):
+    """
+    Remembers the sources and the output digest of every tile that was written in this run.
+    """
+    for tileId, outDigest in digests.items():
+        manifest['tiles'][index.relative(tileId)] = {'sources': index.stamps(tileId), 'digest': outDigest}
+
+def save_shard_report(outRoot: Path, shard: tuple[int, int], inRoots: list[Path], tiles: int, written: int, stats: dict):
+    """
+    Marks a shard as finished: which inputs it merged, how many maps it's responsible for, how many it wrote in this run and its stats.
+    """
+    report = {'version': MANIFEST_VERSION, 'shard': list(shard), 'host': socket.gethostname(), 'finished': time.time(), 'inputs': list(map(str, inRoots)), 'tiles': tiles, 'written': written, 'stats': stats}
+    reportPath = outRoot / f'{SHARD_REPORT_PREFIX}{shard[0]}-of-{shard[1]}.json'
+    tmpPath = reportPath.with_name(reportPath.name + '.tmp')
+    tmpPath.write_text(json.dumps(report), encoding='utf-8')
+    os.replace(tmpPath, reportPath)
+
+def load_shard_reports(outRoot: Path):
+    """
+    All shard reports in an output folder. Broken ones and ones of other versions are left out, their shard counts as not finished.
+    """
+    reports = list()
+    for reportPath in sorted(outRoot.glob(SHARD_REPORT_PREFIX + '*.json')):
+        try:
+            report = json.loads(reportPath.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            continue
+        if report.get('version') == MANIFEST_VERSION:
+            reports.append(report)
+    return reports
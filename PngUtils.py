@@ -0,0 +1,172 @@
+# Small helpers for poking at PNG files directly, without going through ImageMagick
+import struct, zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNGJ (the PNG library JourneyMap uses) is brittle, these are the only chunks we let through. See the comments in Compositing._wand_to_pngj_blob for the full story.
+PNGJ_ALLOWED_CHUNKS = (b'IHDR', b'IDAT', b'IEND')
+
+def read_chunks(data: bytes):
+    """
+    Splits PNG bytes into a list of (chunk type, chunk data) tuples. Raises ValueError if it doesn't look like a PNG.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('Not a PNG (bad signature)')
+    chunks: list[tuple[bytes, bytes]] = list()
+    offset = len(PNG_SIGNATURE)
+    while offset < len(data):
+        if offset + 8 > len(data):
+            raise ValueError('Truncated chunk header')
+        length, chunkType = struct.unpack('>I4s', data[offset:offset + 8])
+        end = offset + 8 + length + 4 # +4 for the CRC
+        if end > len(data):
+            raise ValueError(f'Truncated {chunkType!r} chunk')
+        chunks.append((chunkType, data[offset + 8:offset + 8 + length]))
+        offset = end
+        if chunkType == b'IEND':
+            break
+    return chunks
+
+def pngj_problems(data: bytes):
+    """
+    Checks PNG bytes against what PNGJ accepts: 8-bit RGBA, not interlaced, nothing but IHDR/IDAT/IEND.
+    Returns a list of human readable problems, empty list means the file is fine.
+    """
+    try:
+        chunks = read_chunks(data)
+    except ValueError as e:
+        return [str(e)]
+    problems: list[str] = list()
+    if not chunks or chunks[0][0] != b'IHDR' or len(chunks[0][1]) != 13:
+        return ['IHDR is not the first chunk']
+    width, height, bitDepth, colorType, compression, filterMethod, interlace = struct.unpack('>IIBBBBB', chunks[0][1])
+    if bitDepth != 8:
+        problems.append(f'Bit depth is {bitDepth}, expected 8')
+    if colorType != 6:
+        problems.append(f'Color type is {colorType}, expected 6 (RGBA)')
+    if interlace != 0:
+        problems.append('Image is interlaced')
+    if compression != 0 or filterMethod != 0:
+        problems.append('Unknown compression or filter method')
+    extra = sorted({chunkType.decode('latin-1') for chunkType, irrelevant in chunks if chunkType not in PNGJ_ALLOWED_CHUNKS})
+    if extra:
+        problems.append(f'Extra chunks: {", ".join(extra)}')
+    if chunks[-1][0] != b'IEND':
+        problems.append('Missing IEND')
+    return problems
+
+def is_pngj_safe(data: bytes):
+    return not pngj_problems(data)
+
+# Encoder presets. level is the zlib level, filter is what gets done to every row before compressing it (see the PNG spec, "Filtering").
+# "adaptive" tries every filter on every row and keeps the one that's most likely to compress best (smallest sum of absolute differences), like libpng does.
+# "classic" is what this script always wrote (the settings tuned for PNGJ) and stays the default, "smallest" is a lot slower to write.
+PRESETS = {
+    'fast': {'level': 1, 'filter': 'none'},
+    'balanced': {'level': 6, 'filter': 'up'},
+    'classic': {'level': 9, 'filter': 'none'},
+    'smallest': {'level': 9, 'filter': 'adaptive'},
+}
+DEFAULT_PRESET = 'classic'
+
+# Filter type numbers as they are written in front of every row. ImageMagick uses the same numbers for PNG:compression-filter, with 5 meaning adaptive.
+FILTER_TYPES = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4, 'adaptive': 5}
+
+def _chunk(chunkType: bytes, data: bytes):
+    return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data))
+
+def _filter_rows(pixels, filterName: str):
+    """
+    Applies a PNG filter to every row of a (height, width, 4) uint8 array. Returns the filtered rows with the filter type byte in front, ready for zlib.
+    Encoding only ever looks at the original bytes, so unlike decoding every filter works on the whole image at once.
+    """
+    # Only imported here, whoever hands us pixels already has numpy loaded anyway
+    import numpy as np
+    height, width = pixels.shape[0], pixels.shape[1]
+    rows = pixels.reshape(height, width * 4)
+    if filterName == 'none':
+        filtered = {0: rows}
+    else:
+        # a = left, b = up, c = up-left, all 0 outside the image
+        wide = rows.astype(np.int16)
+        left = np.zeros_like(wide)
+        left[:, 4:] = wide[:, :-4]
+        up = np.zeros_like(wide)
+        up[1:] = wide[:-1]
+        upLeft = np.zeros_like(wide)
+        upLeft[1:, 4:] = wide[:-1, :-4]
+        candidates = {
+            'none': lambda : wide,
+            'sub': lambda : wide - left,
+            'up': lambda : wide - up,
+            'average': lambda : wide - (left + up) // 2,
+            'paeth': lambda : wide - _paeth(left, up, upLeft),
+        }
+        names = list(candidates) if filterName == 'adaptive' else [filterName]
+        filtered = {FILTER_TYPES[name]: (candidates[name]() & 0xFF).astype(np.uint8) for name in names}
+    if len(filtered) == 1:
+        filterType, result = next(iter(filtered.items()))
+        types = np.full((height, 1), filterType, dtype=np.uint8)
+    else:
+        # Read the bytes as signed and pick the filter with the smallest sum of absolute values per row
+        filterTypes = list(filtered)
+        stacked = np.stack([filtered[filterType] for filterType in filterTypes])
+        scores = np.abs(stacked.view(np.int8).astype(np.int32)).sum(axis=2)
+        best = scores.argmin(axis=0)
+        result = stacked[best, np.arange(height)]
+        types = np.array(filterTypes, dtype=np.uint8)[best].reshape(height, 1)
+    return np.concatenate([types, result], axis=1).tobytes()
+
+def _paeth(a, b, c):
+    import numpy as np
+    p = a + b - c
+    pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+    return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+def encode_rgba8(pixels, preset: str = DEFAULT_PRESET):
+    """
+    Writes a (height, width, 4) uint8 array as a PNG that PNGJ is happy with: RGBA8, not interlaced, nothing but IHDR/IDAT/IEND.
+    The preset decides the zlib level and the row filter.
+    """
+    settings = PRESETS[preset]
+    height, width = pixels.shape[0], pixels.shape[1]
+    raw = _filter_rows(pixels, settings['filter'])
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return PNG_SIGNATURE + _chunk(b'IHDR', header) + _chunk(b'IDAT', zlib.compress(raw, settings['level'])) + _chunk(b'IEND', b'')
+
+def write_rgba8_streamed(outPath, pixels, preset: str = DEFAULT_PRESET, rowsPerStrip: int = 256):
+    """
+    Same PNG as encode_rgba8, but written straight into a file a strip of rows at a time. pixels can be anything that slices like a (height, width, 4) uint8 array, an np.memmap of a huge canvas for example, and only one strip of it is ever in memory.
+    """
+    settings = PRESETS[preset]
+    height, width = pixels.shape[0], pixels.shape[1]
+    compressor = zlib.compressobj(settings['level'])
+    with open(outPath, 'wb') as outFile:
+        outFile.write(PNG_SIGNATURE + _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        for start in range(0, height, rowsPerStrip):
+            # The filters look at the row above, so the last row of the previous strip comes along and gets dropped again afterwards
+            above = 1 if start > 0 else 0
+            raw = _filter_rows(pixels[start - above:start + rowsPerStrip], settings['filter'])[above * (width * 4 + 1):]
+            data = compressor.compress(raw)
+            if data:
+                outFile.write(_chunk(b'IDAT', data))
+        outFile.write(_chunk(b'IDAT', compressor.flush()) + _chunk(b'IEND', b''))
+
+def strip_to_pngj(data: bytes):
+    """
+    Makes a PNG PNGJ safe without touching the pixels: keeps IHDR and the already compressed IDAT data as-is and drops every other chunk.
+    Only works if the image already is RGBA8 and not interlaced, returns None otherwise (then it has to be decoded and encoded again).
+    """
+    try:
+        chunks = read_chunks(data)
+    except ValueError:
+        return None
+    if not chunks or chunks[0][0] != b'IHDR' or len(chunks[0][1]) != 13:
+        return None
+    width, height, bitDepth, colorType, compression, filterMethod, interlace = struct.unpack('>IIBBBBB', chunks[0][1])
+    if (bitDepth, colorType, compression, filterMethod, interlace) != (8, 6, 0, 0, 0):
+        return None
+    idat = b''.join(chunkData for chunkType, chunkData in chunks if chunkType == b'IDAT')
+    if not idat:
+        return None
+    return PNG_SIGNATURE + _chunk(b'IHDR', chunks[0][1]) + _chunk(b'IDAT', idat) + _chunk(b'IEND', b'')
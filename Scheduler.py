@@ -0,0 +1,172 @@
+# Decides in which order and in which groups the tiles get handed to the worker processes, and makes sure we never hand out way more than the workers can chew
+import os, re, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+def heaviest_first(tileIds, weigh, window: int = 65536):
+    """
+    Reorders tiles so the heavy ones (lots of layers/bytes) come first. Otherwise a 30 layer tile that gets picked up last keeps one worker busy while all others are already done.
+    Only looks at window tiles at a time, so it never has to hold everything at once.
+    """
+    buffer = list()
+    for tileId in tileIds:
+        buffer.append(tileId)
+        if len(buffer) >= window:
+            yield from sorted(buffer, key=weigh, reverse=True)
+            buffer.clear()
+    yield from sorted(buffer, key=weigh, reverse=True)
+
+def make_batches(tileIds, weigh, targetWeight: float):
+    """
+    Groups tiles into batches of roughly targetWeight. Heavy tiles end up alone, light tiles get bundled so we don't pay the process round trip for every tiny one.
+    """
+    batch: list[int] = list()
+    batchWeight = 0
+    for tileId in tileIds:
+        weight = weigh(tileId)
+        if batch and batchWeight + weight > targetWeight:
+            yield batch
+            batch = list()
+            batchWeight = 0
+        batch.append(tileId)
+        batchWeight += weight
+    if batch:
+        yield batch
+
+def target_weight(tileIds, weigh, jobs: int, batchesPerJob: int = 16):
+    """
+    Picks a batch size so every worker gets about batchesPerJob batches. Enough to balance the load out, not so many that the overhead adds up.
+    """
+    total = sum(map(weigh, tileIds))
+    return max(total / max(jobs * batchesPerJob, 1), 1)
+
+def run_bounded(pool, func, tasks, maxInFlight: int, gate = None):
+    """
+    Like pool.imap_unordered, except that it only pulls a new task out of tasks once a result was taken out. imap_unordered on its own would eat the whole iterator up front.
+    gate can be a function that gets called before every new task goes out, with a function that returns how many tasks are still running. It can block to hold the next task back (see MemoryGovernor).
+    If a task fails (or the results stop being taken out), close the returned generator before terminating the pool. bounded() runs in the pool's task handler thread, and terminate() waits for that thread.
+    """
+    semaphore = threading.Semaphore(maxInFlight)
+    lock = threading.Lock()
+    # Set once nobody takes results out anymore, so bounded() gives up instead of waiting for a slot that never comes
+    cancelled = threading.Event()
+    running = 0
+
+    def bounded():
+        nonlocal running
+        # Wait for a free slot *before* pulling the next task, so lazy tasks are only built (and stamped) once they can actually go out
+        iterator = iter(tasks)
+        while True:
+            while not semaphore.acquire(timeout=0.1):
+                if cancelled.is_set():
+                    return
+            if gate is not None:
+                # Nothing counts as running once cancelled, so the gate stops holding back too
+                gate(lambda : 0 if cancelled.is_set() else running)
+            if cancelled.is_set():
+                return
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            with lock:
+                running += 1
+            yield item
+
+    try:
+        for result in pool.imap_unordered(func, bounded()):
+            with lock:
+                running -= 1
+            semaphore.release()
+            yield result
+    finally:
+        cancelled.set()
+        # Wakes bounded() up right away instead of after the timeout
+        semaphore.release(maxInFlight)
+
+class BoundedExecutor:
+    """
+    A thread pool for disk work that blocks submit() once too much work is queued up, so a slow disk slows down the producer instead of filling up the memory.
+    """
+    def __init__(self, workers: int, maxQueued: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.semaphore = threading.Semaphore(workers + maxQueued)
+
+    def submit(self, func, *args) -> Future:
+        self.semaphore.acquire()
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda x : self.semaphore.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *irrelevant):
+        self.shutdown()
+
+# What a merged tile costs in memory besides its files, per pixel: the float32 result so far, the current layer decoded and as float32, and numpy's temporaries. ImageMagick (Q16 HDRI) is in the same ballpark.
+DECODED_BYTES_PER_PIXEL = 64
+TILE_PIXELS = 512 * 512
+# A fresh worker with Python, numpy and a backend loaded, before it has done anything. Only used until the workers tell us their real size.
+WORKER_BASE_BYTES = 96 * 2**20
+
+def parse_size(text: str):
+    """
+    "4G", "512M", "1.5GB", ... into bytes. A plain number is MiB.
+    """
+    match = re.fullmatch('\\s*(\\d+(?:\\.\\d+)?)\\s*([kmgt]?)i?b?\\s*', text.lower())
+    if match is None:
+        raise ValueError(f'Not a size: {text}')
+    return int(float(match[1]) * 2 ** (10 * ' kmgt'.index(match[2] or 'm')))
+
+def current_rss():
+    """
+    How much memory this process really uses right now (resident set size) in bytes. Only Linux tells us that cheaply, None everywhere else.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def tile_footprint(index, tileId: int):
+    # The files of the tile (all of them are read ahead) plus the decoding and compositing
+    return index.layer_bytes(tileId) + DECODED_BYTES_PER_PIXEL * TILE_PIXELS
+
+def jobs_for_memory(limit: int, jobs: int, heaviest: int):
+    """
+    How many workers fit into limit bytes if every one of them is busy with the heaviest tile. Always at least one.
+    """
+    return max(1, min(jobs, int(limit // (WORKER_BASE_BYTES + 2 * heaviest))))
+
+class MemoryGovernor:
+    """
+    Holds back new tasks while this process and the workers use more than limit bytes together. Workers report their memory with every result (see observe), ours is looked at directly.
+    Never holds back if nothing is running anymore, otherwise it would wait forever for memory that nobody is going to give back.
+    Where the real memory use can't be read (not Linux), it goes by the estimates alone.
+    """
+    def __init__(self, limit: int, interval: float = 0.05):
+        self.limit = limit
+        self.interval = interval
+        self.workers: dict[int, int] = dict()
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def observe(self, pid: int, rss: int | None):
+        if rss is not None:
+            with self.lock:
+                self.workers[pid] = rss
+
+    def used(self):
+        with self.lock:
+            return (current_rss() or 0) + sum(self.workers.values())
+
+    def __call__(self, running):
+        waited = False
+        while running() > 0 and self.used() > self.limit:
+            waited = True
+            time.sleep(self.interval)
+        if waited:
+            self.throttled += 1
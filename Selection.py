@@ -0,0 +1,134 @@
+# Picks out a part of the world to merge: some dimensions, some map types, some regions. Everything else isn't even scanned.
+# JourneyMap saves every map tile as <dimension>/<map type>/<region x>,<region z>.png, one tile is one region (512x512 blocks).
+import math, re, zlib
+
+# Map types are day, night, topo, biome and caves/<slice>. Older versions put the cave slices right into the dimension folder as <slice>/.
+_tileKey = re.compile('^(?P<dimension>[^/]+)/(?P<type>day|night|topo|biome|caves/-?\\d+|-?\\d+)/(?:r\\.)?(?P<x>-?\\d+),(?P<z>-?\\d+)\\.png$')
+
+REGION_BLOCKS = 512
+
+# (dimension, map type, region x, region z)
+type TileKey = tuple[str, str, int, int]
+
+def parse_tile(relative: str):
+    """
+    Splits a path relative to the root (with / as separator) into a TileKey. Returns None for anything that isn't a map tile.
+    """
+    match = _tileKey.match(relative)
+    if match is None:
+        return None
+    return match['dimension'], match['type'], int(match['x']), int(match['z'])
+
+def _numbers(text: str, count: int, name: str):
+    parts = text.replace(' ', '').split(',')
+    if len(parts) != count:
+        raise ValueError(f'{name} needs {count} numbers separated by commas')
+    return [float(part) for part in parts]
+
+def bbox(text: str):
+    """
+    "minX,minZ,maxX,maxZ" in region coordinates (the numbers in the file names), both corners included.
+    """
+    minX, minZ, maxX, maxZ = map(int, _numbers(text, 4, 'A region box'))
+    return min(minX, maxX), min(minZ, maxZ), max(minX, maxX), max(minZ, maxZ)
+
+def circle(text: str):
+    """
+    "x,z,radius" in blocks, like the coordinates in the F3 screen.
+    """
+    x, z, radius = _numbers(text, 3, 'A radius')
+    if radius < 0:
+        raise ValueError('The radius can\'t be negative')
+    return x, z, radius
+
+def shard(text: str):
+    """
+    "i/N", the i-th of N shards counting from 0.
+    """
+    parts = text.replace(' ', '').split('/')
+    if len(parts) != 2 or not all(map(lambda x : x.isdigit(), parts)):
+        raise ValueError('A shard is written as i/N, like 0/4')
+    index, count = map(int, parts)
+    if not 0 <= index < count:
+        raise ValueError(f'Shard {index}/{count} doesn\'t exist, they go from 0/{count} to {count - 1}/{count}')
+    return index, count
+
+def shard_of(relative: str, count: int):
+    # crc32 and not hash(), that one changes with every Python process. Every machine has to agree on this.
+    return zlib.crc32(relative.encode('utf-8')) % count
+
+def split_list(values: list[str] | None):
+    # Flags can be given multiple times and/or with commas: --type day,topo --type biome
+    if not values:
+        return None
+    return [part for value in values for part in value.replace(' ', '').split(',') if part]
+
+class Selection:
+    """
+    Which tiles to merge. Every criterion that's None lets everything through, so Selection() selects the whole world.
+    types can contain "caves" for every cave slice, or "caves/3" for a single one.
+    regionBox is (minX, minZ, maxX, maxZ) in regions, circle is (x, z, radius) in blocks. A tile is in the circle if any block of it is.
+    shard is (i, N) and only lets through the tiles whose path falls into the i-th of N shards, see shard_of.
+    """
+    def __init__(self, dimensions: list[str] | None = None, types: list[str] | None = None, regionBox: tuple[int, int, int, int] | None = None, circle: tuple[float, float, float] | None = None, shard: tuple[int, int] | None = None):
+        self.dimensions = set(dimensions) if dimensions else None
+        self.types = set(types) if types else None
+        self.regionBox = regionBox
+        self.circle = circle
+        self.shard = shard
+
+    def everything(self):
+        return self.dimensions is None and self.types is None and self.regionBox is None and self.circle is None and self.shard is None
+
+    def _type_wanted(self, mapType: str):
+        if self.types is None or mapType in self.types:
+            return True
+        return 'caves' in self.types and (mapType.startswith('caves/') or mapType.lstrip('-').isdigit())
+
+    def _region_wanted(self, x: int, z: int):
+        if self.regionBox is not None:
+            minX, minZ, maxX, maxZ = self.regionBox
+            if not (minX <= x <= maxX and minZ <= z <= maxZ):
+                return False
+        if self.circle is not None:
+            centerX, centerZ, radius = self.circle
+            # Closest block of the region to the center
+            closestX = min(max(centerX, x * REGION_BLOCKS), x * REGION_BLOCKS + REGION_BLOCKS - 1)
+            closestZ = min(max(centerZ, z * REGION_BLOCKS), z * REGION_BLOCKS + REGION_BLOCKS - 1)
+            if math.hypot(closestX - centerX, closestZ - centerZ) > radius:
+                return False
+        return True
+
+    def wants_dir(self, relative: str):
+        """
+        If a directory (relative to the root, ending with /) can contain selected tiles at all. Used while scanning, so skipped folders are never listed.
+        """
+        parts = relative.rstrip('/').split('/')
+        if self.dimensions is not None and parts[0] not in self.dimensions:
+            return False
+        if self.types is None or len(parts) < 2:
+            return True
+        if parts[1] == 'caves':
+            if len(parts) == 2:
+                return 'caves' in self.types or any(map(lambda x : x.startswith('caves/'), self.types))
+            return self._type_wanted('caves/' + parts[2])
+        return self._type_wanted(parts[1])
+
+    def wants_tile(self, relative: str):
+        """
+        If a file (relative to the root) is a selected map tile.
+        With only a shard set, every .png counts like in a full scan, even ones that don't look like a map tile. Otherwise the shards and --combine wouldn't agree on what has to be merged.
+        """
+        if not relative.endswith('.png'):
+            return False
+        if self.shard is not None and shard_of(relative, self.shard[1]) != self.shard[0]:
+            return False
+        if self.dimensions is None and self.types is None and self.regionBox is None and self.circle is None:
+            return True
+        key = parse_tile(relative)
+        if key is None:
+            return False
+        dimension, mapType, x, z = key
+        if self.dimensions is not None and dimension not in self.dimensions:
+            return False
+        return self._type_wanted(mapType) and self._region_wanted(x, z)
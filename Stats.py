@@ -0,0 +1,163 @@
+# Where does the time go? Collects wall and CPU time of every phase, the timings of every merged tile and what every worker did.
+# Prints a summary at the end and can write everything as a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev) plus cProfile dumps of the workers.
+import cProfile, json, os, threading, time
+import multiprocessing.util
+from contextlib import contextmanager
+from pathlib import Path
+
+# The parts a merged tile's time is split into, in the order they happen
+TILE_STEPS = ('read', 'decode', 'composite', 'encode', 'write')
+
+def new_tile_record(relative: str, layers: int, bytesIn: int):
+    return {'tile': relative, 'layers': layers, 'bytesIn': bytesIn, 'bytesOut': 0, 'readWait': 0.0, **{step: 0.0 for step in TILE_STEPS}, 'start': 0.0, 'end': 0.0, 'pid': os.getpid()}
+
+def _event(name: str, category: str, start: float, seconds: float, pid: int, tid: int, args: dict | None = None):
+    # One "complete" event of the Chrome trace format, times are in microseconds
+    event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round(start * 1e6), 'dur': round(seconds * 1e6), 'pid': pid, 'tid': tid}
+    if args:
+        event['args'] = args
+    return event
+
+class Recorder:
+    """
+    Lives in the main process. Phases are always timed, that's cheap. Tiles and trace events are only kept if detailed is set, with millions of tiles that adds up.
+    Workers send their numbers back together with their results, see add_batch and add_tile.
+    """
+    def __init__(self, detailed: bool = False):
+        self.detailed = detailed
+        self.phases: dict[str, dict[str, float]] = dict()
+        self.tiles: list[dict] = list()
+        self.workers: dict[int, dict[str, float]] = dict()
+        self.events: list[dict] = list()
+        # Reports of the shards gathered by --combine, by "i/N"
+        self.shards: dict[str, dict] = dict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - wall
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'cpuSeconds': 0.0})
+            phase['seconds'] += seconds
+            # Only this process. The CPU time of the workers is in the worker table.
+            phase['cpuSeconds'] += time.process_time() - cpu
+            if self.detailed:
+                with self.lock:
+                    self.events.append(_event(name, 'phase', start, seconds, os.getpid(), 0))
+
+    def add_batch(self, batch: dict):
+        """
+        Takes what a worker reports about one batch: pid, queued (when we handed it out), start, end, cpuSeconds and tiles.
+        """
+        with self.lock:
+            worker = self.workers.setdefault(batch['pid'], {'batches': 0, 'tiles': 0, 'busySeconds': 0.0, 'cpuSeconds': 0.0, 'queueWait': 0.0})
+            worker['batches'] += 1
+            worker['tiles'] += batch['tiles']
+            worker['busySeconds'] += batch['end'] - batch['start']
+            worker['cpuSeconds'] += batch['cpuSeconds']
+            worker['queueWait'] += max(batch['start'] - batch['queued'], 0)
+            if self.detailed:
+                self.events.append(_event('batch', 'batch', batch['start'], batch['end'] - batch['start'], batch['pid'], 1, {'tiles': batch['tiles']}))
+
+    def add_tile(self, record: dict):
+        with self.lock:
+            self.tiles.append(record)
+            self.events.append(_event(record['tile'], 'tile', record['start'], record['end'] - record['start'], record['pid'], 2, {step: record[step] for step in (*TILE_STEPS[:-1], 'layers', 'bytesIn', 'bytesOut')}))
+
+    def add_write(self, record: dict, start: float, seconds: float):
+        with self.lock:
+            record['write'] = seconds
+            self.events.append(_event(record['tile'], 'write', start, seconds, os.getpid(), threading.get_ident()))
+
+    def add_shard(self, report: dict):
+        with self.lock:
+            self.shards['/'.join(map(str, report['shard']))] = {key: report[key] for key in ('host', 'finished', 'inputs', 'tiles', 'written', 'stats')}
+
+    def histogram(self):
+        """
+        How long tiles took from the start of reading to the end of writing, in power of two buckets. Returns [(upper bound in ms, count)], the last bucket has no upper bound.
+        """
+        counts: dict[int, int] = dict()
+        for record in self.tiles:
+            milliseconds = (record['end'] - record['start'] + record['write']) * 1000
+            bucket = 0
+            while milliseconds >= 2 ** bucket and bucket < 16:
+                bucket += 1
+            counts[bucket] = counts.get(bucket, 0) + 1
+        if not counts:
+            return list()
+        return [(2 ** bucket if bucket < 16 else None, counts.get(bucket, 0)) for bucket in range(max(counts) + 1)]
+
+    def slowest(self, count: int = 10):
+        return sorted(self.tiles, key=lambda x : x['end'] - x['start'] + x['write'], reverse=True)[:count]
+
+    def summary(self):
+        """
+        Everything as one JSON-able dict, without the trace events.
+        """
+        stepTotals = {step: sum(record[step] for record in self.tiles) for step in (*TILE_STEPS, 'readWait')}
+        return {
+            'phases': self.phases,
+            'workers': {str(pid): {**worker, 'tilesPerSecond': worker['tiles'] / max(worker['busySeconds'], 1e-9)} for pid, worker in self.workers.items()},
+            'tiles': {
+                'count': len(self.tiles),
+                'layers': sum(record['layers'] for record in self.tiles),
+                'bytesIn': sum(record['bytesIn'] for record in self.tiles),
+                'bytesOut': sum(record['bytesOut'] for record in self.tiles),
+                'seconds': stepTotals,
+            },
+            'histogram': [{'belowMs': bound, 'tiles': count} for bound, count in self.histogram()],
+            'slowest': self.slowest(),
+            **({'shards': self.shards} if self.shards else dict()),
+        }
+
+    def print_summary(self):
+        print('')
+        print('Phases (wall / CPU of this process):')
+        for name, phase in self.phases.items():
+            print(f'- {name}: {phase["seconds"]:.2f}s / {phase["cpuSeconds"]:.2f}s')
+        if self.workers:
+            print('Workers:')
+            for pid, worker in sorted(self.workers.items()):
+                print(f'- {pid}: {worker["tiles"]} tiles in {worker["batches"]} batches, {worker["tiles"] / max(worker["busySeconds"], 1e-9):.1f} tiles/s, busy {worker["busySeconds"]:.2f}s, CPU {worker["cpuSeconds"]:.2f}s, waited in queue {worker["queueWait"]:.2f}s')
+        if not self.tiles:
+            return
+        summary = self.summary()['tiles']
+        total = sum(summary['seconds'][step] for step in TILE_STEPS) or 1e-9
+        print(f'Tiles: {summary["count"]} merged from {summary["layers"]} layers, {summary["bytesIn"] / 2**20:.1f} MiB in, {summary["bytesOut"] / 2**20:.1f} MiB out')
+        print('Time per step: ' + ', '.join(f'{step} {summary["seconds"][step]:.2f}s ({round(summary["seconds"][step] / total * 100, 1)}%)' for step in TILE_STEPS) + f', waiting for reads {summary["seconds"]["readWait"]:.2f}s')
+        print('Latency:')
+        histogram = self.histogram()
+        widest = max(count for bound, count in histogram) or 1
+        lowest = 0
+        for bound, count in histogram:
+            label = f'{lowest}-{bound} ms' if bound is not None else f'>= {lowest} ms'
+            print(f'{label:>14} | {"#" * round(count / widest * 40):<40} | {count}')
+            lowest = bound
+        print('Slowest tiles:')
+        for record in self.slowest():
+            print(f'- {record["tile"]}: {(record["end"] - record["start"] + record["write"]) * 1000:.1f} ms, {record["layers"]} layers (' + ', '.join(f'{step} {record[step] * 1000:.1f}' for step in TILE_STEPS) + ')')
+
+    def save(self, outDir: Path):
+        """
+        Writes trace.json (Chrome trace) and stats.json (the summary) into outDir.
+        """
+        os.makedirs(str(outDir), exist_ok=True)
+        (outDir / 'trace.json').write_text(json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'}), encoding='utf-8')
+        (outDir / 'stats.json').write_text(json.dumps(self.summary(), indent=2), encoding='utf-8')
+
+def _dump_profile(profiler: cProfile.Profile, outPath: Path):
+    profiler.disable()
+    profiler.dump_stats(str(outPath))
+
+def profile_worker(outDir: Path):
+    """
+    Runs cProfile in this worker process until it shuts down, then dumps it to outDir/worker-<pid>.prof. Look at it with python -m pstats or snakeviz.
+    Pool workers run the multiprocessing finalizers when they're closed normally. A terminated pool (Ctrl-C) leaves no dumps behind.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    multiprocessing.util.Finalize(None, _dump_profile, args=(profiler, outDir / f'worker-{os.getpid()}.prof'), exitpriority=16)
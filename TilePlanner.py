@@ -0,0 +1,150 @@
+# Decides what actually has to be composited and what can just be put into the output as-is
+import os, shutil, sys
+from array import array
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+import CompareFolders as cf
+import PngUtils as pu
+import Manifest as mf
+import ZipArchives as za
+
+LINK_MODES = ('copy', 'hardlink', 'reflink')
+
+# From linux/fs.h, _IOW(0x94, 9, int). Only used if the filesystem supports it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def plan_tiles(index: cf.TileIndex, tileIds = None):
+    """
+    Sorts tiles into two piles: ones that only exist in a single input (nothing to layer, just copy it) and ones that exist in multiple inputs and need compositing.
+    Both piles are arrays of tile ids. Without tileIds, every tile of the index gets planned.
+    """
+    singleSource = array('q')
+    needsCompositing = array('q')
+    for tileId in (index.tiles() if tileIds is None else tileIds):
+        if index.layer_count(tileId) == 1:
+            singleSource.append(tileId)
+        else:
+            needsCompositing.append(tileId)
+    return singleSource, needsCompositing
+
+def _hash_row(x):
+    index, tileId, row = x
+    return row, mf.digest(index.source(row, index.relative(tileId)).read_bytes())
+
+def dedupe_contributors(index: cf.TileIndex, tileIds):
+    """
+    Finds contributors of a tile that are byte for byte copies of each other (backups, a friend's export of the same server, the same world exported twice, ...) and only keeps the topmost copy.
+    A lower copy can't add anything as long as every pixel is either solid or fully see-through, which is what JourneyMap writes: wherever the top copy is see-through, the lower one is as well.
+    Only contributors that have the same size as another contributor of the same tile get read and hashed, everything else can't be a copy anyway.
+    Marks the dropped rows in the index and returns two arrays: tiles that are down to one contributor (they can just be copied now) and tiles that still need compositing.
+    """
+    tasks = list()
+    for tileId in tileIds:
+        rows = index.rows(tileId)
+        sizes = [index.sizes[row] for row in rows]
+        for row, size in zip(rows, sizes):
+            if sizes.count(size) > 1:
+                tasks.append((index, tileId, row))
+    # Pure disk work again, threads it is
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        for row, rowDigest in tqdm(executor.map(_hash_row, tasks), total=len(tasks), desc='Hashing Maps'):
+            index.digests[row] = rowDigest
+
+    collapsed = array('q')
+    remaining = array('q')
+    for tileId in tileIds:
+        seen: set[str] = set()
+        # Top down, so the topmost copy is the one that stays
+        for row in reversed(index.rows(tileId)):
+            rowDigest = index.digests.get(row)
+            if rowDigest is None:
+                continue
+            if rowDigest in seen:
+                index.duplicates.add(row)
+            seen.add(rowDigest)
+        if index.layer_count(tileId) == 1:
+            collapsed.append(tileId)
+        else:
+            remaining.append(tileId)
+    return collapsed, remaining
+
+def _reflink(src: Path, dst: Path):
+    # Copy-on-write clone, so no data gets duplicated on disk. Raises OSError if the OS or filesystem can't do it.
+    if not sys.platform.startswith('linux'):
+        raise OSError('Reflinks are only supported on Linux')
+    import fcntl
+    with open(src, 'rb') as srcFile, open(dst, 'wb') as dstFile:
+        fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+
+def place_file(src: Path, dst: Path, mode: str = 'copy', data: bytes | None = None):
+    """
+    Puts src at dst, either as a plain copy, a hardlink or a reflink. Falls back to a plain copy if linking isn't possible (different drives, unsupported filesystem, ...)
+    If the contents of src were already read, pass them as data so copying doesn't read the file again.
+    """
+    os.makedirs(str(dst.parent), exist_ok=True)
+    # Everything goes to a temporary name first and then replaces dst in one go. An interrupted run can't leave a half written file behind that the manifest takes for finished,
+    # and an old hardlink at dst gets replaced instead of written through into someones input folder.
+    tmpPath = dst.with_name(dst.name + '.tmp')
+    if tmpPath.exists() or tmpPath.is_symlink():
+        tmpPath.unlink()
+    placed = False
+    if mode != 'copy':
+        try:
+            if mode == 'hardlink':
+                os.link(src, tmpPath)
+            else:
+                _reflink(src, tmpPath)
+            placed = True
+        except OSError:
+            pass # Just copy it then
+    if not placed:
+        if data is None:
+            shutil.copyfile(src, tmpPath)
+        else:
+            tmpPath.write_bytes(data)
+    os.replace(tmpPath, dst)
+    # Renaming onto a hardlink of the same file does nothing at all, the temporary name is still there then
+    if tmpPath.exists():
+        tmpPath.unlink()
+
+def _helper_place_single_source(x):
+    index, outRoot, tileId, mode, check = x
+    src = index.sources(tileId)[0]
+    # Nothing to link if the source or the output is an archive
+    if isinstance(src, za.ZipMember) or isinstance(outRoot, za.ZipOutput):
+        mode = 'copy'
+    # Copying reads the file anyway, so we can get the digest for free. Links never read it, so they don't get one.
+    data = src.read_bytes() if check or mode == 'copy' else None
+    if check and not pu.is_pngj_safe(data):
+        # Usually it's just some extra chunks, those can be dropped without decoding anything
+        data = pu.strip_to_pngj(data)
+        if data is None:
+            return tileId, False, None
+        mode = 'copy'
+    if isinstance(outRoot, za.ZipOutput):
+        # Stored as-is, so the PNG doesn't get compressed a second time
+        outRoot.write(index.relative(tileId), data)
+    else:
+        place_file(src, outRoot / index.relative(tileId), mode, data)
+    return tileId, True, None if data is None else mf.digest(data)
+
+def place_single_sources(outRoot: Path | za.ZipOutput, index: cf.TileIndex, tileIds, mode: str = 'copy', check: bool = False):
+    """
+    Copies/links all single source tiles into the output. If check is set, every source is checked once to see if PNGJ can deal with it. Sources that only have extra chunks get copied without them.
+    Returns the tiles that still failed the check (those have to be decoded and encoded again) and the digests of the placed tiles for the manifest.
+    """
+    rejected = array('q')
+    digests: dict[int, str | None] = dict()
+    tasks = map(lambda x : [index, outRoot, x, mode, check], tileIds)
+    # This is pure disk work, so threads are good enough and way cheaper than processes
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        results = tqdm(executor.map(_helper_place_single_source, tasks), total=len(tileIds), desc='Copying Single Source Maps')
+        for tileId, placed, outDigest in results:
+            if placed:
+                digests[tileId] = outDigest
+            else:
+                rejected.append(tileId)
+    if rejected:
+        print(f'{len(rejected)} single source maps are not PNGJ compatible and will be re-encoded')
+    return rejected, digests
@@ -0,0 +1,114 @@
+# Lets JourneyMap export ZIPs be used directly as inputs and outputs, without extracting anything to disk
+import re, threading, time, zipfile
+from pathlib import Path, PurePosixPath
+
+# <dimension>/<map type>/<tile>.png, used to find where the data starts if there's no waypoint file to go by
+_tilePattern = re.compile('(?:^|/)([^/]+)/(?:day|night|topo|biome|caves/-?\\d+|-?\\d+)/[^/]+\\.png$')
+
+def is_zip(path: Path):
+    return path.suffix.lower() == '.zip'
+
+def data_prefix(zipPath: Path):
+    """
+    Finds where the JourneyMap data starts inside an archive. Exports usually have it right at the top, but someone might have zipped the folder itself, then it's one level deeper.
+    Goes by the waypoint file if there is one, otherwise by the first map tile. Returns the prefix every member name starts with, either '' or something like 'My~server/'.
+    """
+    with zipfile.ZipFile(zipPath) as archive:
+        names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    for name in names:
+        if name == 'waypoints/WaypointData.dat' or name.endswith('/waypoints/WaypointData.dat'):
+            return name[:-len('waypoints/WaypointData.dat')]
+    for name in names:
+        match = _tilePattern.search(name)
+        if match:
+            return name[:match.start(1)]
+    return ''
+
+def _zip_time(info: zipfile.ZipInfo):
+    # ZIPs only store local time with 2 second precision, but that's good enough to order layers
+    return time.mktime((*info.date_time, 0, 0, -1))
+
+def scan_zip(rootIndex: int, zipPath: Path, prefix: str = ''):
+    """
+    Lists all files of an archive as ScanEntries (see CompareFolders), relative to prefix. The timestamp stored in the archive stands in for the last modified time.
+    """
+    entries = list()
+    with zipfile.ZipFile(zipPath) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.startswith(prefix):
+                continue
+            entries.append((rootIndex, info.filename[len(prefix):], _zip_time(info), info.file_size))
+    return entries
+
+# Every process keeps its archives open, opening a ZIP means reading its whole directory
+_openArchives: dict[str, zipfile.ZipFile] = dict()
+_openLock = threading.Lock()
+
+def forget_open_archives():
+    """
+    Call this in freshly forked worker processes. An archive opened by the parent shares its file position with the child, so reading from both at once mixes things up.
+    """
+    _openArchives.clear()
+
+def _archive(zipPath: Path):
+    key = str(zipPath)
+    with _openLock:
+        archive = _openArchives.get(key)
+        if archive is None:
+            archive = _openArchives[key] = zipfile.ZipFile(zipPath)
+    return archive
+
+class ZipMember:
+    """
+    A file inside an archive. Behaves enough like a Path (read_bytes, str) that the merging code doesn't have to care where a layer comes from.
+    """
+    def __init__(self, zipPath: Path, name: str):
+        self.zipPath = zipPath
+        self.name = name
+
+    def read_bytes(self):
+        return _archive(self.zipPath).read(self.name)
+
+    def info(self):
+        return _archive(self.zipPath).getinfo(self.name)
+
+    def __str__(self):
+        return f'{str(self.zipPath)}!/{self.name}'
+
+    def __repr__(self):
+        return f'ZipMember({str(self)!r})'
+
+def member(zipPath: Path, relative: str, prefix: str | None = None):
+    """
+    Returns the ZipMember for a path relative to the data root of the archive, or None if it's not in there.
+    """
+    if prefix is None:
+        prefix = data_prefix(zipPath)
+    candidate = ZipMember(zipPath, prefix + relative)
+    try:
+        candidate.info()
+    except KeyError:
+        return None
+    return candidate
+
+def stamp(zipMember: ZipMember):
+    info = zipMember.info()
+    return [str(zipMember), _zip_time(info), info.file_size]
+
+class ZipOutput:
+    """
+    An output archive that gets written while merging. Safe to use from multiple threads.
+    PNGs are stored as-is, they're already compressed and squeezing them again only costs time.
+    """
+    def __init__(self, zipPath: Path):
+        self.zipPath = zipPath
+        self.archive = zipfile.ZipFile(zipPath, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.lock = threading.Lock()
+
+    def write(self, relative: str, data: bytes):
+        compression = zipfile.ZIP_STORED if PurePosixPath(relative).suffix.lower() == '.png' else zipfile.ZIP_DEFLATED
+        with self.lock:
+            self.archive.writestr(relative, data, compress_type=compression)
+
+    def close(self):
+        self.archive.close()
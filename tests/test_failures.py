@@ -0,0 +1,63 @@
+# A failing map must stop the merge with its error, not leave it hanging. Run with: python -m unittest discover tests
+import multiprocessing, subprocess, sys, tempfile, threading, time, unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import Scheduler as sch
+
+def _fail_first(x):
+    if x == 0:
+        raise ValueError('task 0 failed')
+    # Slow enough that the pool is still waiting to hand out more when task 0 fails
+    time.sleep(0.01)
+    return x
+
+class RunBoundedTest(unittest.TestCase):
+    def test_failing_task_lets_pool_terminate(self):
+        outcome = dict()
+
+        def run():
+            pool = multiprocessing.Pool(2)
+            results = sch.run_bounded(pool, _fail_first, range(100), 4)
+            try:
+                list(results)
+            except ValueError as e:
+                outcome['error'] = e
+                results.close()
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+            outcome['done'] = True
+
+        # Daemon thread, so a hang fails the test instead of the whole run
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(60)
+        self.assertTrue(outcome.get('done'), 'terminating the pool hung')
+        self.assertIn('task 0 failed', str(outcome.get('error')))
+
+class MergeFailureTest(unittest.TestCase):
+    def test_corrupt_map_stops_merge(self):
+        try:
+            import numpy
+            from PIL import Image
+        except ImportError:
+            self.skipTest('needs numpy and Pillow')
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            for inputName in ('in0', 'in1'):
+                for x in range(6):
+                    for z in range(6):
+                        tilePath = tmp / inputName / 'overworld' / 'day' / f'{x},{z}.png'
+                        tilePath.parent.mkdir(parents=True, exist_ok=True)
+                        Image.new('RGBA', (16, 16), (x * 40, z * 40, 100, 255 if inputName == 'in0' else 128)).save(tilePath)
+            # Overlaps with in0, so it has to be composited and the worker chokes on it. Big, so it's handed out first while the rest still waits.
+            (tmp / 'in1' / 'overworld' / 'day' / '2,3.png').write_bytes(b'not a png' * 100000)
+            result = subprocess.run([sys.executable, str(ROOT / 'JourneyMapMerger.py'), str(tmp / 'out'), str(tmp / 'in0'), str(tmp / 'in1'), '-y', '-m', '--backend', 'numpy', '-j', '1'], capture_output=True, text=True, timeout=60)
+            self.assertNotEqual(result.returncode, 0)
+            self.assertIn('UnidentifiedImageError', result.stderr)
+
+if __name__ == '__main__':
+    unittest.main()